@@ -1,17 +1,648 @@
 #from openai.api_resources.completion import Completion
-from flask import Flask, render_template, request
-from joblib import dump, load
-import sklearn
-import psycopg2
-import openai
 import os
 
-""" This is a flask app that takes picks and displays the contents of the database """
+""" sklearn, joblib and openai are imported where they are first used, the warm up at the bottom loads the model in the background """
+
+""" ASYNC_MODE=gevent serves every request from a greenlet, the standard library has to be patched before anything else imports it """
+ASYNC_MODE = os.environ.get('ASYNC_MODE', 'threads')
+if ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, Response, render_template, request, g, jsonify, stream_with_context
+from psycopg2 import pool as psycopg2_pool
+from psycopg2 import extras as psycopg2_extras
+from psycopg2 import errors as psycopg2_errors
+from werkzeug.wsgi import ClosingIterator
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import itertools
+import bisect
+import select
+import threading
+import fcntl
+import hashlib
+import sqlite3
+import numpy
+import psycopg2
+import time
+import json
+import sys
+import io
+import re
 
-print(os.environ)
+if ASYNC_MODE == 'gevent':
+    """ psycopg2 waits for postgres through gevent, a greenlet waiting on a query lets the others run """
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+""" This is a flask app that takes picks and displays the contents of the database """
 
 app = Flask(__name__)
 
+""" Metrics settings, all of them can be overridden from the environment """
+METRICS_BUCKETS = tuple(float(b) for b in os.environ.get('METRICS_BUCKETS', '0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10').split(','))
+SLOW_QUERY_SECONDS = float(os.environ.get('SLOW_QUERY_SECONDS', 1))
+PROFILE_ROUTE = os.environ.get('PROFILE_ROUTE')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.01))
+
+'''
+Histogram counts how long something took into the buckets of METRICS_BUCKETS, once per combination of labels
+It renders itself in the prometheus text format, the buckets there are cumulative
+Example: with query_seconds.time(query='SELECT public.robots'): cur.execute(...)
+'''
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = sorted(buckets)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, seconds, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect.bisect_left(self.buckets, seconds)
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.help, "# TYPE " + self.name + " histogram"]
+        with self._lock:
+            series = sorted((key, list(counts), total, count) for key, (counts, total, count) in self._series.items())
+        for key, counts, total, count in series:
+            labels = [name + '="' + escape_label(value) + '"' for name, value in zip(self.labels, key)]
+            cumulative = 0
+            for bucket, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(self.name + "_bucket{" + ",".join(labels + ['le="' + repr(bucket) + '"']) + "} " + str(cumulative))
+            lines.append(self.name + "_bucket{" + ",".join(labels + ['le="+Inf"']) + "} " + str(count))
+            lines.append(self.name + "_sum" + ("{" + ",".join(labels) + "}" if labels else "") + " " + repr(total))
+            lines.append(self.name + "_count" + ("{" + ",".join(labels) + "}" if labels else "") + " " + str(count))
+        return lines
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+request_seconds = Histogram('simtooreal_request_seconds', 'Time from receiving a request until its response was sent, streamed pages included', ('route', 'method', 'status'))
+query_seconds = Histogram('simtooreal_query_seconds', 'Time spent in cursor.execute by statement and table', ('query',))
+model_load_seconds = Histogram('simtooreal_model_load_seconds', 'Time to read and deserialize the classifier')
+model_predict_seconds = Histogram('simtooreal_model_predict_seconds', 'Time the classifier spent scoring, one question or a batch chunk', ('kind',))
+completion_seconds = Histogram('simtooreal_completion_seconds', 'Latency of calls to the completion API')
+predict_batch_size = Histogram('simtooreal_predict_batch_size', 'Questions from /question scored together in one micro-batch', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+predict_queue_seconds = Histogram('simtooreal_predict_queue_seconds', 'Time a question from /question waited for its micro-batch to start')
+histograms = [request_seconds, query_seconds, model_load_seconds, model_predict_seconds, completion_seconds, predict_batch_size, predict_queue_seconds]
+
+""" The statement and the first table it names, INSERT public.picks, keeps the number of query labels small """
+QUERY_LABEL = re.compile(r"^\s*(\w+)(?:.*?\b(?:FROM|INTO|UPDATE|TABLE)\s+([\w.]+))?", re.IGNORECASE | re.DOTALL)
+
+def query_label(query):
+    if isinstance(query, bytes):
+        query = query[:300].decode('utf-8', 'replace')
+    elif not isinstance(query, str):
+        return 'composed'
+    match = QUERY_LABEL.match(query[:300])
+    if match is None:
+        return 'other'
+    return " ".join(part for part in (match.group(1).upper(), match.group(2)) if part)
+
+'''
+TimedCursor is the cursor class of every pooled connection, each execute is timed into query_seconds
+Statements slower than SLOW_QUERY_SECONDS are printed in full
+'''
+class TimedCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            elapsed = time.perf_counter() - t0
+            query_seconds.observe(elapsed, query=query_label(query))
+            if elapsed >= SLOW_QUERY_SECONDS:
+                print("slow query took %0.3fs: " % elapsed + (query if isinstance(query, str) else repr(query))[:1000])
+
+'''
+PerProcess calls start once in every process, the first time ensure() is called there, and returns what it made
+Threads, sockets, sqlite connections and file locks do not survive a fork (gunicorn workers), so everything
+that owns one makes it through a PerProcess and every worker process gets its own
+A Condition still lists the parent's waiting threads in the child and a notify could go to one of them,
+so a start whose thread waits on a Condition makes a new one as well
+A start that raises is tried again by the next ensure()
+Example: executor = PerProcess(lambda: ThreadPoolExecutor(4)) ... executor.ensure().submit(work)
+'''
+class PerProcess:
+    def __init__(self, start):
+        self.start = start
+        self._lock = threading.Lock()
+        self._pid = None
+        self._value = None
+        os.register_at_fork(after_in_child=self._forked)
+
+    def _forked(self):
+        """ A thread of the parent may have held the lock when it forked, that thread does not exist in the child """
+        self._lock = threading.Lock()
+
+    def ensure(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._value = self.start()
+                    self._pid = os.getpid()
+        return self._value
+
+'''
+SamplingProfiler looks at the stacks of the threads serving one route every interval seconds
+and counts them as collapsed stacks, the input format of flamegraph.pl and speedscope
+It only samples while a request of that route is running, the rest of the app pays nothing for it
+Example: PROFILE_ROUTE=/question then https://www.simtooreal.com/profile
+Output: app.py:question;app.py:predict_category;...;_base.py:decision_function 42
+'''
+class SamplingProfiler:
+    def __init__(self, route, interval):
+        self.route = route
+        self.interval = interval
+        self._cond = threading.Condition()
+        self._threads = {}
+        self._sampler = PerProcess(self._start_sampler)
+        self.samples = {}
+        self.requests = 0
+
+    def _start_sampler(self):
+        """ The requests the parent was sampling are not running in this process """
+        self._cond = threading.Condition()
+        self._threads = {}
+        threading.Thread(target=self._sample, name='profiler', daemon=True).start()
+
+    def start(self, ident):
+        self._sampler.ensure()
+        with self._cond:
+            self._threads[ident] = self._threads.get(ident, 0) + 1
+            self.requests += 1
+            self._cond.notify()
+
+    def stop(self, ident):
+        with self._cond:
+            if self._threads.get(ident, 0) <= 1:
+                self._threads.pop(ident, None)
+            else:
+                self._threads[ident] -= 1
+
+    def _sample(self):
+        while True:
+            with self._cond:
+                while not self._threads:
+                    self._cond.wait()
+                idents = list(self._threads)
+            frames = sys._current_frames()
+            for ident in idents:
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    stack.append(os.path.basename(frame.f_code.co_filename) + ":" + frame.f_code.co_name)
+                    frame = frame.f_back
+                if stack:
+                    key = ";".join(reversed(stack))
+                    with self._cond:
+                        self.samples[key] = self.samples.get(key, 0) + 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        with self._cond:
+            samples = sorted(self.samples.items(), key=lambda sample: -sample[1])
+        return "".join(stack + " " + str(count) + "\n" for stack, count in samples)
+
+profiler = SamplingProfiler(PROFILE_ROUTE, PROFILE_INTERVAL) if PROFILE_ROUTE else None
+
+'''
+RouteTimer wraps the wsgi app so a request is timed until the last byte of its response has been sent,
+a streamed dashboard is only finished then, long after the view function returned
+'''
+class RouteTimer:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        t0 = time.perf_counter()
+        status = []
+
+        def timed_start_response(status_line, headers, exc_info=None):
+            status.append(status_line.split(' ', 1)[0])
+            return start_response(status_line, headers, exc_info)
+
+        def done():
+            request_seconds.observe(time.perf_counter() - t0, route=environ.get('simtooreal.route', 'unmatched'),
+                method=environ.get('REQUEST_METHOD'), status=status[0] if status else '500')
+            if 'simtooreal.profiled' in environ:
+                profiler.stop(environ['simtooreal.profiled'])
+            if 'simtooreal.slot' in environ:
+                route_limiter.release(environ['simtooreal.slot'])
+
+        try:
+            body = self.wsgi_app(environ, timed_start_response)
+        except BaseException:
+            done()
+            raise
+        return ClosingIterator(body, done)
+
+app.wsgi_app = RouteTimer(app.wsgi_app)
+
+@app.before_request
+def label_route():
+    """ The url rule and not the path is the label, /table/picks and /table/robots are one route """
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    request.environ['simtooreal.route'] = route
+    if profiler is not None and route == profiler.route:
+        request.environ['simtooreal.profiled'] = threading.get_ident()
+        profiler.start(threading.get_ident())
+
+""" Route limits, ROUTE_LIMITS=/gpt=16,/question=32 and ROUTE_TIMEOUTS=/gpt=30 in seconds """
+ROUTE_LIMITS = {route: int(n) for route, n in (part.rsplit('=', 1) for part in os.environ.get('ROUTE_LIMITS', '/gpt=16').split(',') if part)}
+ROUTE_TIMEOUTS = {route: float(n) for route, n in (part.rsplit('=', 1) for part in os.environ.get('ROUTE_TIMEOUTS', '/gpt=30').split(',') if part)}
+ROUTE_QUEUE_TIMEOUT = float(os.environ.get('ROUTE_QUEUE_TIMEOUT', 10))
+
+'''
+RouteLimiter caps how many requests of a route run at once so a slow route, like /gpt waiting on the
+completion API, can never take every worker thread or greenlet and leave /pick waiting behind it
+A request that finds its route full waits for a slot until its route timeout and then gets a 503
+Example: ROUTE_LIMITS=/gpt=16 lets the 17th concurrent /gpt request wait for one of the first 16 to finish
+'''
+class RouteLimiter:
+    def __init__(self, limits, timeouts, queue_timeout):
+        self.limits = limits
+        self.timeouts = timeouts
+        self.queue_timeout = queue_timeout
+        self._slots = {route: threading.BoundedSemaphore(n) for route, n in limits.items()}
+        self._lock = threading.Lock()
+        self.in_flight = {route: 0 for route in limits}
+        self.rejected = {route: 0 for route in limits}
+
+    def acquire(self, route):
+        if route not in self._slots:
+            return True
+        if not self._slots[route].acquire(timeout=self.timeouts.get(route, self.queue_timeout)):
+            with self._lock:
+                self.rejected[route] += 1
+            return False
+        with self._lock:
+            self.in_flight[route] += 1
+        return True
+
+    def release(self, route):
+        with self._lock:
+            self.in_flight[route] -= 1
+        self._slots[route].release()
+
+    def stats(self):
+        with self._lock:
+            return {route: {'limit': self.limits[route], 'timeout': self.timeouts.get(route), 'in_flight': self.in_flight[route], 'rejected': self.rejected[route]} for route in self.limits}
+
+route_limiter = RouteLimiter(ROUTE_LIMITS, ROUTE_TIMEOUTS, ROUTE_QUEUE_TIMEOUT)
+
+@app.before_request
+def limit_route():
+    """ The slot is given back by RouteTimer once the whole response, streamed tables included, has gone out """
+    route = request.environ['simtooreal.route']
+    if route in ROUTE_TIMEOUTS:
+        g.deadline = time.monotonic() + ROUTE_TIMEOUTS[route]
+    if not route_limiter.acquire(route):
+        return "Too many " + route + " requests are running, try again shortly", 503, {'Retry-After': '1'}
+    if route in ROUTE_LIMITS:
+        request.environ['simtooreal.slot'] = route
+
+'''
+time_left() is how many seconds the current request has left before its route timeout, None without one
+Example: translator.translate(human, timeout=time_left())
+'''
+def time_left():
+    if 'deadline' not in g:
+        return None
+    return max(0.0, g.deadline - time.monotonic())
+
+""" Connection pool settings, all of them can be overridden from the environment """
+POSTGRESQL_POOL_MIN = int(os.environ.get('POSTGRESQL_POOL_MIN', 1))
+POSTGRESQL_POOL_MAX = int(os.environ.get('POSTGRESQL_POOL_MAX', 10))
+POSTGRESQL_POOL_TIMEOUT = float(os.environ.get('POSTGRESQL_POOL_TIMEOUT', 30))
+POSTGRESQL_POOL_PING_AFTER = float(os.environ.get('POSTGRESQL_POOL_PING_AFTER', 30))
+POSTGRESQL_CONNECT_TIMEOUT = int(os.environ.get('POSTGRESQL_CONNECT_TIMEOUT', 5))
+
+'''
+ConnectionPool is a process wide pool of postgres connections shared by every route
+It wraps psycopg2's ThreadedConnectionPool so that a checkout waits for a free connection
+instead of failing straight away, connections that sat idle are health checked before
+they are handed out, and a pool inherited through a fork (gunicorn workers) is rebuilt
+in the child so two processes never share one socket
+Example: conn = db_pool.getconn() ... db_pool.putconn(conn)
+'''
+class ConnectionPool:
+    def __init__(self, minconn, maxconn, timeout, ping_after, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.connect_kwargs = connect_kwargs
+        self._lock = threading.Lock()
+        self._pool = None
+        self._opened = PerProcess(self._open)
+        self._slots = None
+        self._last_used = {}
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.checkouts = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.timeouts = 0
+        self.discarded = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def _open(self):
+        """ The parent's sockets are simply left alone """
+        self._pool = psycopg2_pool.ThreadedConnectionPool(self.minconn, self.maxconn, **self.connect_kwargs)
+        """ psycopg2 closes a returned connection once minconn are idle, after the first minconn are opened
+        every returned connection is kept so a busy process does not reconnect on most checkouts """
+        self._pool.minconn = self.maxconn
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+        self._last_used = {}
+        self._reset_stats()
+
+    def _healthy(self, conn):
+        """ Only connections that have been idle for a while pay for a round trip to the server """
+        if conn.closed:
+            return False
+        try:
+            conn.autocommit = True
+            if time.monotonic() - self._last_used.get(id(conn), 0) < self.ping_after:
+                return True
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self, timeout=None):
+        self._opened.ensure()
+        timeout = self.timeout if timeout is None else timeout
+        t0 = time.monotonic()
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise psycopg2_pool.PoolError("timed out after %0.1fs waiting for a database connection" % timeout)
+        waited = time.monotonic() - t0
+        try:
+            """ After a failover every idle connection may be dead, they are all discarded before one is handed out
+            and once none are left idle the pool opens a fresh one, which is checked like the others """
+            for attempt in range(self.maxconn + 1):
+                conn = self._pool.getconn()
+                if self._healthy(conn):
+                    break
+                self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+                with self._lock:
+                    self.discarded += 1
+            else:
+                raise psycopg2.OperationalError("no healthy database connection after %d attempts" % (self.maxconn + 1))
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        return conn
+
+    def putconn(self, conn):
+        """ A connection left broken or mid transaction is closed rather than handed to the next request """
+        broken = conn.closed or conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        if broken:
+            self._last_used.pop(id(conn), None)
+            with self._lock:
+                self.discarded += 1
+        else:
+            self._last_used[id(conn)] = time.monotonic()
+        self._pool.putconn(conn, close=bool(broken))
+        with self._lock:
+            self.in_use -= 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'min_size': self.minconn,
+                'max_size': self.maxconn,
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'saturation': self.in_use / self.maxconn,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'discarded': self.discarded,
+                'wait_seconds_total': self.wait_seconds_total,
+                'wait_seconds_max': self.wait_seconds_max,
+                'wait_seconds_avg': self.wait_seconds_total / self.checkouts if self.checkouts else 0.0,
+            }
+
+""" These are the postgres environment variables to avoid storing sensitive info in the github repo """
+db_pool = ConnectionPool(POSTGRESQL_POOL_MIN, POSTGRESQL_POOL_MAX, POSTGRESQL_POOL_TIMEOUT, POSTGRESQL_POOL_PING_AFTER,
+    host=os.environ.get('POSTGRESQL_HOST'), port=5432, database="simtooreal",
+    user=os.environ.get('POSTGRESQL_USER_NAME'), password=os.environ.get('POSTGRESQL_PASSWORD'), cursor_factory=TimedCursor,
+    connect_timeout=POSTGRESQL_CONNECT_TIMEOUT)
+
+'''
+get_db() borrows one pooled connection for the current request, asking twice gives the same connection
+Example: cur = get_db().cursor()
+'''
+def get_db():
+    if 'db_conn' not in g:
+        g.db_conn = db_pool.getconn()
+    return g.db_conn
+
+@app.teardown_appcontext
+def return_db(exception):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        db_pool.putconn(conn)
+
+'''
+pool_stats() reports how long requests waited for a connection and how saturated the pool is
+Example: https://www.simtooreal.com/pool
+Output: {"in_use": 2, "max_size": 10, "saturation": 0.2, ...}
+'''
+@app.route('/pool')
+def pool_stats():
+    return db_pool.stats()
+
+'''
+metrics() reports the request, query, model and completion API histograms and the connection pool
+in the prometheus text format, point a prometheus scrape job at it
+Example: https://www.simtooreal.com/metrics
+Output: simtooreal_request_seconds_bucket{route="/pick",method="POST",status="200",le="0.005"} 1234 ...
+'''
+@app.route('/metrics')
+def metrics():
+    lines = []
+    for histogram in histograms:
+        lines += histogram.render()
+
+    pool = db_pool.stats()
+    for name, kind, help, value in [
+            ('simtooreal_db_connections_in_use', 'gauge', 'Pooled connections currently lent to a request', pool['in_use']),
+            ('simtooreal_db_connections_max', 'gauge', 'Size limit of the connection pool', pool['max_size']),
+            ('simtooreal_db_connections_peak', 'gauge', 'Most connections lent out at once', pool['peak_in_use']),
+            ('simtooreal_db_checkouts_total', 'counter', 'Connections taken from the pool', pool['checkouts']),
+            ('simtooreal_db_checkout_timeouts_total', 'counter', 'Requests that gave up waiting for a connection', pool['timeouts']),
+            ('simtooreal_db_connections_discarded_total', 'counter', 'Broken connections closed instead of reused', pool['discarded']),
+            ('simtooreal_db_checkout_wait_seconds_total', 'counter', 'Time spent waiting for a free connection', pool['wait_seconds_total'])]:
+        lines += ["# HELP " + name + " " + help, "# TYPE " + name + " " + kind, name + " " + repr(value)]
+
+    routes = route_limiter.stats()
+    lines += ["# HELP simtooreal_route_in_flight Requests of a limited route running now", "# TYPE simtooreal_route_in_flight gauge"]
+    lines += ['simtooreal_route_in_flight{route="' + escape_label(route) + '"} ' + str(r['in_flight']) for route, r in routes.items()]
+    lines += ["# HELP simtooreal_route_rejected_total Requests turned away because their route was full", "# TYPE simtooreal_route_rejected_total counter"]
+    lines += ['simtooreal_route_rejected_total{route="' + escape_label(route) + '"} ' + str(r['rejected']) for route, r in routes.items()]
+
+    lines += ["# HELP simtooreal_model_info The classifier being served", "# TYPE simtooreal_model_info gauge",
+        'simtooreal_model_info{version="' + escape_label(str(classifier.version)) + '"} 1']
+    return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
+
+'''
+profile() returns what the sampling profiler saw of PROFILE_ROUTE as collapsed stacks, most frequent first
+Example: PROFILE_ROUTE=/question python3 app.py, then curl https://www.simtooreal.com/profile | flamegraph.pl > question.svg
+'''
+@app.route('/profile')
+def profile():
+    if profiler is None:
+        return "the profiler is off, start the app with PROFILE_ROUTE set to the route to profile", 404
+    return Response(profiler.collapsed(), mimetype='text/plain')
+
+""" Classifier settings, the trainer in grid_search_text_feature_extraction.py writes both artifacts, the compact clf.model is served when it is there """
+MODEL_PATH = os.environ.get('MODEL_PATH', 'clf.model' if os.path.exists('clf.model') else 'clf.joblib')
+MODEL_RELOAD_INTERVAL = float(os.environ.get('MODEL_RELOAD_INTERVAL', 10))
+
+'''
+ClassifierHolder keeps one deserialized classifier in memory for the whole process
+A background thread watches the artifact on disk and when its mtime or size changes it
+loads the new file completely before swapping it in, so a request either sees the old
+model or the new one and never a half loaded one
+Anything that depends on the model, like a cache of its answers, can register a callback in on_load
+Example: clf, version = classifier.get()
+'''
+class ClassifierHolder:
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._current = None
+        self._stat = None
+        self._watcher = PerProcess(lambda: threading.Thread(target=self._watch, name='model-reloader', daemon=True).start())
+        self.version = None
+        self.format = None
+        self.mtime = None
+        self.loaded_at = None
+        self.load_seconds = None
+        self.reloads = 0
+        self.last_error = None
+        self.on_load = []
+
+    def load(self):
+        """ The version hash and the model always come from the same open file, a pickle is read whole and
+        a serving model is memory mapped so worker processes share its pages """
+        st = os.stat(self.path)
+        t0 = time.monotonic()
+        """ Importing either format pulls in sklearn, the slowest import of the app, so it waits until here """
+        import serving_model
+        with open(self.path, 'rb') as f:
+            data = f.read()
+            if data.startswith(serving_model.MAGIC):
+                clf = serving_model.load(f)
+                model_format = 'serving'
+            else:
+                from joblib import load
+                clf = load(io.BytesIO(data))
+                model_format = 'joblib'
+        version = hashlib.sha1(data).hexdigest()[:12]
+        with self._lock:
+            if self._current is not None:
+                self.reloads += 1
+            self._current = (clf, version)
+            self._stat = (st.st_mtime, st.st_size)
+            self.version = version
+            self.format = model_format
+            self.mtime = st.st_mtime
+            self.loaded_at = time.time()
+            self.load_seconds = time.monotonic() - t0
+            self.last_error = None
+        model_load_seconds.observe(self.load_seconds)
+        for callback in self.on_load:
+            callback()
+        print("loaded model " + version + " from " + self.path + " in %0.3fs" % self.load_seconds)
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                st = os.stat(self.path)
+                if (st.st_mtime, st.st_size) != self._stat:
+                    self.load()
+            except Exception as e:
+                """ Keep serving the model we have, the trainer may still be writing a new one """
+                self.last_error = repr(e)
+
+    def get(self):
+        self._watcher.ensure()
+        if self._current is None:
+            """ Requests that arrive during the first load wait for it instead of each loading the model again """
+            with self._load_lock:
+                if self._current is None:
+                    self.load()
+        return self._current
+
+    def loaded(self):
+        return self._current is not None
+
+    def info(self):
+        return {
+            'path': self.path,
+            'version': self.version,
+            'format': self.format,
+            'mtime': self.mtime,
+            'loaded_at': self.loaded_at,
+            'load_seconds': self.load_seconds,
+            'reloads': self.reloads,
+            'last_error': self.last_error,
+        }
+
+""" The model is loaded by the warm up at the bottom of the file, or by the first request that needs it """
+classifier = ClassifierHolder(MODEL_PATH, MODEL_RELOAD_INTERVAL)
+
+'''
+model_info() reports which classifier is being served
+Example: https://www.simtooreal.com/model
+Output: {"version": "3f2a9c1d0b7e", "mtime": 1650000000.0, "reloads": 0, ...}
+'''
+@app.route('/model')
+def model_info():
+    return classifier.info()
+
 '''
 Pick takes a json object that has key value pairs that are robot_name and robot_item
 Both robot_name and robot_item values are strings
@@ -23,10 +654,210 @@ def pick():
     if request.method == 'POST':
         robot_name = request.args.get('robot_name')
         item_name = request.args.get('item_name')
+        if PICK_WRITE_BEHIND:
+            """ The pick is on disk and queued, postgres gets it with the next batch """
+            try:
+                parse_bulk_pick({'robot_name': robot_name, 'item_name': item_name})
+            except ValueError as e:
+                return str(e), 400
+            if not pick_buffer.append(robot_name, item_name):
+                return "Too many picks are waiting to be written, try again shortly", 503
+            return f"{robot_name} has successfully picked {item_name}"
         return find_ids_and_insert_picks(robot_name, item_name)
     else:
         return "Submit a pick by sending a POST with JSON key value pairs for robot_name and robot_item"
 
+""" How many robot and item names each process remembers the id of """
+NAME_CACHE_SIZE = int(os.environ.get('NAME_CACHE_SIZE', 10000))
+
+'''
+LRUCache is a small thread safe least recently used map that counts its hits and misses
+When it is given a ttl in seconds an entry older than that counts as a miss and is dropped
+Example: cache = LRUCache(2); cache.put('walle', 1); cache.get('walle')
+Output: 1
+'''
+class LRUCache:
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                value, expires = self._data[key]
+                if expires is None or time.monotonic() < expires:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self.expirations += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'max_size': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+""" The name lookups the pick paths are allowed to do, table and column names never come from a request """
+NAME_TABLES = {
+    'robot': ('public.robots', 'robot_id', 'robot_name'),
+    'item': ('public.items', 'item_id', 'item_name'),
+}
+name_caches = {kind: LRUCache(NAME_CACHE_SIZE) for kind in NAME_TABLES}
+
+""" Snapshot settings, all of them can be overridden from the environment """
+SNAPSHOT_CACHE_SIZE = int(os.environ.get('SNAPSHOT_CACHE_SIZE', 100))
+SNAPSHOT_CACHE_TTL = float(os.environ.get('SNAPSHOT_CACHE_TTL', 60))
+SNAPSHOT_NOTIFY = os.environ.get('SNAPSHOT_NOTIFY', 'False') == 'True'
+SNAPSHOT_CHANNEL = 'simtooreal_snapshots'
+
+'''
+SnapshotCache keeps the rows of queries on tables that rarely change, per table and for at most ttl seconds
+A write path that changes one of the tables calls changed() and every snapshot of it is thrown away,
+with SNAPSHOT_NOTIFY the change is also sent to the other worker processes through postgres NOTIFY
+and a listener thread in each of them throws its snapshots away too
+A query that was running while its table changed does not store what it read
+Example: rows = snapshots.rows(cur, 'categories', "SELECT * FROM public.categories;")
+Output: [(1, 'Sales/Promotions'), (2, 'Shipping'), ...]
+'''
+class SnapshotCache:
+    def __init__(self, tables, maxsize, ttl, notify):
+        self._caches = {name: LRUCache(maxsize, ttl) for name in tables}
+        self._generations = {name: 0 for name in tables}
+        self._lock = threading.Lock()
+        self._listener = PerProcess(lambda: threading.Thread(target=self._listen, name='snapshot-listener', daemon=True).start())
+        self.notify = notify
+        self.invalidations = 0
+        self.notifications = 0
+        self.listening = False
+
+    def __contains__(self, name):
+        return name in self._caches
+
+    def rows(self, cur, name, query, params=None):
+        rows = self.get(name, query, params)
+        if rows is None:
+            rows = self.fetch(cur, name, query, params)
+        return rows
+
+    def get(self, name, query, params=None):
+        """ The snapshot of a query, None when it has to be read again """
+        if self.notify:
+            self._listener.ensure()
+        return self._caches[name].get((query, tuple(sorted(params.items())) if params else ()))
+
+    def fetch(self, cur, name, query, params=None):
+        generation = self._generations[name]
+        cur.execute(query, params)
+        rows = cur.fetchall()
+        with self._lock:
+            if self._generations[name] == generation:
+                self._caches[name].put((query, tuple(sorted(params.items())) if params else ()), rows)
+        return rows
+
+    def invalidate(self, name):
+        with self._lock:
+            self._generations[name] += 1
+            self.invalidations += 1
+            self._caches[name].clear()
+
+    def changed(self, cur, name):
+        """ Called by the write paths, inside a transaction the notification goes out when it commits """
+        self.invalidate(name)
+        if self.notify:
+            cur.execute("SELECT pg_notify(%(channel)s, %(name)s);", {'channel': SNAPSHOT_CHANNEL, 'name': name})
+
+    def _listen(self):
+        delay = 1
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**db_pool.connect_kwargs)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute("LISTEN " + SNAPSHOT_CHANNEL + ";")
+                """ Anything may have changed while nobody was listening """
+                for name in self._caches:
+                    self.invalidate(name)
+                self.listening = True
+                delay = 1
+                while True:
+                    select.select([conn], [], [], 60)
+                    conn.poll()
+                    while conn.notifies:
+                        name = conn.notifies.pop(0).payload
+                        if name in self._caches:
+                            self.invalidate(name)
+                            self.notifications += 1
+            except psycopg2.Error as e:
+                self.listening = False
+                print("snapshot listener lost its connection, retrying in %ds: %r" % (delay, e))
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def stats(self):
+        stats = {name: cache.stats() for name, cache in self._caches.items()}
+        stats.update(invalidations=self.invalidations, notifications=self.notifications, notify=self.notify, listening=self.listening)
+        return stats
+
+""" Picks change with every request so they are always read from the database """
+snapshots = SnapshotCache(('robots', 'items', 'questions', 'categories'), SNAPSHOT_CACHE_SIZE, SNAPSHOT_CACHE_TTL, SNAPSHOT_NOTIFY)
+
+'''
+find_or_create_id() takes a cursor, a kind ('robot' or 'item') and a name and returns (id, created)
+A cached name costs nothing, otherwise a single upsert creates the row if needed and returns its id,
+so two concurrent first picks of a new name no longer collide on the UNIQUE constraint
+Example: find_or_create_id(cur, 'robot', 'walle')
+Output: (1, False)
+'''
+def find_or_create_id(cur, kind, name):
+    cached = name_caches[kind].get(name)
+    if cached is not None:
+        return cached, False
+
+    """ DO UPDATE instead of DO NOTHING so RETURNING also gives back rows that already existed, xmax = 0 only for a fresh row """
+    table, id_column, name_column = NAME_TABLES[kind]
+    cur.execute(f"INSERT INTO {table} ({name_column}) VALUES (%(name)s) ON CONFLICT ({name_column}) DO UPDATE SET {name_column} = EXCLUDED.{name_column} RETURNING {id_column}, (xmax = 0);", {'name': name})
+    row_id, created = cur.fetchone()
+    name_caches[kind].put(name, row_id)
+    return row_id, created
+
 '''
 find_ids_and_insert_picks() takes a robot_name and robot_item
 both robot_name and robot_item values are strings, if robot and item name do not exist then conveniently
@@ -37,60 +868,860 @@ Output: walle has successfully picked candy bar
 def find_ids_and_insert_picks(robot_name, item_name):
     result = ''
 
-    """ These are the postgres environment variables to avoid storing sensitie info in the github repo """
-    POSTGRESQL_HOST = os.environ.get('POSTGRESQL_HOST')
-    POSTGRESQL_USER_NAME = os.environ.get('POSTGRESQL_USER_NAME')
-    POSTGRESQL_PASSWORD = os.environ.get('POSTGRESQL_PASSWORD')
-
-    """ We use psycopg2 to create a database connection either locally or in AWS """
-    conn = psycopg2.connect(host=POSTGRESQL_HOST, port = 5432, database="simtooreal", user=POSTGRESQL_USER_NAME, password=POSTGRESQL_PASSWORD)
-    conn.autocommit=True
+    """ Borrow a connection from the shared pool, it is handed back when the request is torn down """
+    conn = get_db()
 
     """ Create a cursor object """
     cur = conn.cursor()
 
-    """ A query that takes gives the robot_id of robots given their robot_name """
-    cur.execute("SELECT * FROM public.robots WHERE robot_name=%(robot_name)s", {'robot_name': robot_name } )
-    row = cur.fetchone()
-
-    """ If there is no robot with that name create it in the database and then look up the ID of that new robot """
-    if row == None:
-        cur.execute("INSERT INTO public.robots values(default,%(robot_name)s);", {'robot_name': robot_name } )
+    """ Look up or create the robot and the item, for names we have seen before this does not touch the database """
+    robot_id, robot_created = find_or_create_id(cur, 'robot', robot_name)
+    if robot_created:
         result += "There were no robots with the name " + robot_name + " so we created it\n"
-        cur.execute("SELECT * FROM public.robots WHERE robot_name=%(robot_name)s", {'robot_name': robot_name } )
-        row = cur.fetchone()
-        
-
-    robot_id = str(f"{row[0]}")
-
-    """ Look up the item ID from the item name """
-    cur.execute("SELECT * FROM public.items WHERE item_name=%(item_name)s", {'item_name': item_name } )
-    row = cur.fetchone()
+        snapshots.changed(cur, 'robots')
 
-    """ If there is no item with that name create it in the database and then look up the ID of that new item """
-    if row == None:
-        cur.execute("INSERT INTO public.items values(default,%(item_name)s);", {'item_name': item_name } )
+    item_id, item_created = find_or_create_id(cur, 'item', item_name)
+    if item_created:
         result += "There were no items with the name " + item_name + " so we created it\n"
-        cur.execute("SELECT * FROM public.items WHERE item_name=%(item_name)s", {'item_name': item_name } )
-        row = cur.fetchone()
-
-    item_id = str(f"{row[0]}")
+        snapshots.changed(cur, 'items')
 
     """ Now we are ready to store a pick timestamp and IDs """
-    cur.execute(f"INSERT INTO public.picks values(default, current_timestamp, {item_id}, {robot_id});")
+    try:
+        cur.execute("INSERT INTO public.picks values(default, current_timestamp, %(item_id)s, %(robot_id)s);", {'item_id': item_id, 'robot_id': robot_id})
+    except psycopg2_errors.ForeignKeyViolation:
+        """ A cached id can go stale when a robot or item is deleted by hand, forget both and look them up again """
+        name_caches['robot'].discard(robot_name)
+        name_caches['item'].discard(item_name)
+        robot_id, _ = find_or_create_id(cur, 'robot', robot_name)
+        item_id, _ = find_or_create_id(cur, 'item', item_name)
+        cur.execute("INSERT INTO public.picks values(default, current_timestamp, %(item_id)s, %(robot_id)s);", {'item_id': item_id, 'robot_id': robot_id})
 
     '''
-    Close the cursor and connection too so the server can allocate
-    bandwidth to other requests
+    Close the cursor, the connection itself goes back to the pool
+    when the request is torn down
     '''
     cur.close()
-    conn.close()
 
     if result == '':
         return f"{robot_name} has successfully picked {item_name}"
     else:
         return result + "<br>" + f"{robot_name} has successfully picked {item_name}"
 
+'''
+cache_stats() reports the size and hit ratio of the in process caches
+Example: https://www.simtooreal.com/caches
+Output: {"robot_ids": {"hits": 980, "misses": 20, "hit_ratio": 0.98, ...}, "item_ids": {...}}
+'''
+@app.route('/caches')
+def cache_stats():
+    stats = {kind + '_ids': cache.stats() for kind, cache in name_caches.items()}
+    stats['predictions'] = prediction_cache.stats()
+    stats['translations'] = translator.stats()
+    stats['snapshots'] = snapshots.stats()
+    return stats
+
+""" The most records a single bulk request may carry """
+PICKS_BULK_MAX = int(os.environ.get('PICKS_BULK_MAX', 10000))
+
+'''
+resolve_names() takes a cursor, a kind ('robot' or 'item') and a collection of names
+Cached names are answered from memory, the rest are created if missing and looked up in two
+set based statements no matter how many names there are
+Example: resolve_names(cur, 'robot', ['walle', 'optimus'])
+Output: ({'walle': 1, 'optimus': 2}, {'optimus'})
+'''
+def resolve_names(cur, kind, names):
+    table, id_column, name_column = NAME_TABLES[kind]
+    ids = {}
+    for name in set(names):
+        cached = name_caches[kind].get(name)
+        if cached is not None:
+            ids[name] = cached
+    names = list(set(names) - set(ids))
+    if not names:
+        return ids, set()
+
+    """ Create whatever does not exist yet, a concurrent insert of the same name is simply skipped """
+    cur.execute(f"INSERT INTO {table} ({name_column}) SELECT unnest(%(names)s::varchar[]) ON CONFLICT ({name_column}) DO NOTHING RETURNING {name_column};", {'names': names})
+    created = {row[0] for row in cur.fetchall()}
+
+    cur.execute(f"SELECT {name_column}, {id_column} FROM {table} WHERE {name_column} = ANY(%(names)s);", {'names': names})
+    for name, row_id in cur.fetchall():
+        ids[name] = row_id
+        name_caches[kind].put(name, row_id)
+    return ids, created
+
+'''
+parse_bulk_pick() checks one record of a bulk request and returns (robot_name, item_name, pick_timestamp)
+pick_timestamp is None when the record does not carry one, it then defaults to the time of the insert
+A ValueError explains what is wrong with a record that can not be stored
+Example: parse_bulk_pick({'robot_name': 'walle', 'item_name': 'candy bar', 'pick_timestamp': '2022-04-01T12:00:00'})
+Output: ('walle', 'candy bar', datetime.datetime(2022, 4, 1, 12, 0))
+'''
+def parse_bulk_pick(record):
+    if not isinstance(record, dict):
+        raise ValueError("record must be an object")
+    robot_name = record.get('robot_name')
+    item_name = record.get('item_name')
+    for key, value in (('robot_name', robot_name), ('item_name', item_name)):
+        if not isinstance(value, str) or value == '':
+            raise ValueError(key + " must be a non empty string")
+        if len(value) > 255:
+            raise ValueError(key + " must be at most 255 characters")
+        if '\x00' in value:
+            """ postgres text can not hold NUL, a buffered pick with one would never be written """
+            raise ValueError(key + " must not contain NUL characters")
+    pick_timestamp = record.get('pick_timestamp')
+    if pick_timestamp is not None:
+        try:
+            pick_timestamp = datetime.fromisoformat(str(pick_timestamp))
+        except ValueError:
+            raise ValueError("pick_timestamp must be an ISO 8601 timestamp")
+        if pick_timestamp.tzinfo is not None:
+            """ The column has no time zone and postgres would drop the offset, so the time is converted to UTC first """
+            pick_timestamp = pick_timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return robot_name, item_name, pick_timestamp
+
+'''
+write_picks() takes a cursor and a list of (robot_name, item_name, pick_timestamp) and stores all of them
+Robots and items are resolved with resolve_names() and the picks go in with one multi row insert
+A pick_timestamp of None means the time of the insert
+Example: write_picks(cur, [('walle', 'candy bar', None)])
+Output: ([42], set(), set())
+'''
+def write_picks(cur, picks):
+    for attempt in range(2):
+        robot_ids, created_robots = resolve_names(cur, 'robot', [p[0] for p in picks])
+        item_ids, created_items = resolve_names(cur, 'item', [p[1] for p in picks])
+
+        """ One statement for the whole batch, RETURNING keeps the order of the VALUES list """
+        rows = [(ts, item_ids[item_name], robot_ids[robot_name]) for robot_name, item_name, ts in picks]
+        try:
+            pick_ids = psycopg2_extras.execute_values(cur,
+                "INSERT INTO public.picks (pick_timestamp, item_id, robot_id) VALUES %s RETURNING pick_id;",
+                rows, template="(COALESCE(%s::timestamp, current_timestamp), %s, %s)", page_size=len(rows), fetch=True)
+            if created_robots:
+                snapshots.changed(cur, 'robots')
+            if created_items:
+                snapshots.changed(cur, 'items')
+            return [row[0] for row in pick_ids], created_robots, created_items
+        except psycopg2_errors.ForeignKeyViolation:
+            """ Some cached id went stale, start over from the database once """
+            if attempt:
+                raise
+            for cache in name_caches.values():
+                cache.clear()
+
+'''
+picks_bulk() takes a JSON list of picks, or an object with the list under "picks", in the body of a POST
+Robots and items that do not exist are created, all picks are written with one multi row insert and
+every record gets its own status so a fleet controller can flush its buffered picks in one call
+Example: curl -X POST https://www.simtooreal.com/picks/bulk -H 'Content-Type: application/json'
+    -d '[{"robot_name": "walle", "item_name": "candy bar", "pick_timestamp": "2022-04-01T12:00:00"}]'
+Output: {"accepted": 1, "rejected": 0, "results": [{"index": 0, "status": "ok", "pick_id": 42}], ...}
+'''
+@app.route('/picks/bulk', methods=['POST'])
+def picks_bulk():
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = body.get('picks')
+    if not isinstance(body, list):
+        return jsonify(error="expected a JSON list of picks or an object with a \"picks\" list"), 400
+    if len(body) > PICKS_BULK_MAX:
+        return jsonify(error=f"at most {PICKS_BULK_MAX} picks may be sent in one request"), 413
+
+    results = [None] * len(body)
+    valid = []
+    for index, record in enumerate(body):
+        try:
+            valid.append((index,) + parse_bulk_pick(record))
+        except ValueError as e:
+            results[index] = {'index': index, 'status': 'error', 'error': str(e)}
+
+    created_robots, created_items = set(), set()
+    if valid:
+        cur = get_db().cursor()
+        pick_ids, created_robots, created_items = write_picks(cur, [v[1:] for v in valid])
+        cur.close()
+
+        for (index, _, _, _), pick_id in zip(valid, pick_ids):
+            results[index] = {'index': index, 'status': 'ok', 'pick_id': pick_id}
+
+    return jsonify(
+        accepted=len(valid),
+        rejected=len(body) - len(valid),
+        created_robots=sorted(created_robots),
+        created_items=sorted(created_items),
+        results=results,
+    )
+
+""" Page sizes for /picks """
+PICKS_PAGE_SIZE = int(os.environ.get('PICKS_PAGE_SIZE', 100))
+PICKS_PAGE_SIZE_MAX = int(os.environ.get('PICKS_PAGE_SIZE_MAX', 1000))
+
+'''
+picks_query() pages through picks in time order as JSON, optionally only those of one robot and/or one item
+since and until are ISO timestamps, limit is the page size (at most PICKS_PAGE_SIZE_MAX) and after is the
+"next" cursor of the previous page, every page is one indexed range scan however deep into the history it is
+Example: https://www.simtooreal.com/picks?robot_name=walle&since=2022-04-01T00:00:00&limit=2
+Output: {"picks": [{"pick_id": 7, "pick_timestamp": "2022-04-01T08:00:00", "robot_name": "walle", "item_name": "doll"}, ...], "next": "2022-04-01T09:30:00_12"}
+'''
+@app.route('/picks')
+def picks_query():
+    params = {
+        'robot_name': request.args.get('robot_name'),
+        'item_name': request.args.get('item_name'),
+        'limit': max(1, min(request.args.get('limit', PICKS_PAGE_SIZE, type=int), PICKS_PAGE_SIZE_MAX)) + 1,
+    }
+    try:
+        for key in ('since', 'until'):
+            params[key] = datetime.fromisoformat(request.args[key]) if key in request.args else None
+        if 'after' in request.args:
+            after_timestamp, after_id = request.args['after'].rsplit('_', 1)
+            params['after_timestamp'] = datetime.fromisoformat(after_timestamp)
+            params['after_id'] = int(after_id)
+    except ValueError:
+        return jsonify(error="since and until must be ISO 8601 timestamps and after must be a next cursor from /picks"), 400
+
+    """ Only the filters that were asked for go into the query, the values themselves are always parameters """
+    conditions = []
+    if params['robot_name'] is not None:
+        conditions.append("r.robot_name = %(robot_name)s")
+    if params['item_name'] is not None:
+        conditions.append("i.item_name = %(item_name)s")
+    if params['since'] is not None:
+        conditions.append("p.pick_timestamp >= %(since)s")
+    if params['until'] is not None:
+        conditions.append("p.pick_timestamp < %(until)s")
+    if 'after_id' in params:
+        conditions.append("(p.pick_timestamp, p.pick_id) > (%(after_timestamp)s, %(after_id)s)")
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+
+    cur = get_db().cursor()
+    cur.execute(f"SELECT p.pick_id, p.pick_timestamp, r.robot_name, i.item_name FROM public.picks p JOIN public.robots r ON p.robot_id=r.robot_id JOIN public.items i ON p.item_id=i.item_id {where} ORDER BY p.pick_timestamp, p.pick_id LIMIT %(limit)s;", params)
+    rows = cur.fetchall()
+    cur.close()
+
+    """ One row more than the page is asked for, it only tells us there is a next page """
+    next_cursor = None
+    if len(rows) == params['limit']:
+        rows = rows[:-1]
+        next_cursor = rows[-1][1].isoformat() + '_' + str(rows[-1][0])
+
+    return jsonify(
+        picks=[{'pick_id': pick_id, 'pick_timestamp': ts.isoformat(), 'robot_name': robot_name, 'item_name': item_name} for pick_id, ts, robot_name, item_name in rows],
+        next=next_cursor,
+    )
+
+""" Write behind settings for /pick, off unless PICK_WRITE_BEHIND=True """
+PICK_WRITE_BEHIND = os.environ.get('PICK_WRITE_BEHIND', 'False') == 'True'
+PICK_LOG_DIR = os.environ.get('PICK_LOG_DIR', 'pick_logs')
+PICK_LOG_FSYNC = os.environ.get('PICK_LOG_FSYNC', 'False') == 'True'
+PICK_FLUSH_SIZE = int(os.environ.get('PICK_FLUSH_SIZE', 500))
+PICK_FLUSH_INTERVAL = float(os.environ.get('PICK_FLUSH_INTERVAL', 0.5))
+PICK_BUFFER_MAX = int(os.environ.get('PICK_BUFFER_MAX', 100000))
+
+""" Errors that say postgres is unavailable rather than that a pick is bad, a batch failing with one of them is retried whole """
+PICK_TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2_pool.PoolError)
+
+'''
+PickBuffer accepts picks into memory and hands them to postgres later in batches
+Every pick is first appended to a log of this process in PICK_LOG_DIR, a background thread writes a batch
+once PICK_FLUSH_SIZE picks are waiting or the oldest has waited PICK_FLUSH_INTERVAL seconds
+The log is kept in segments, after every flush new picks go to a new segment and the segments whose picks
+are all in postgres are deleted, the oldest one left gets a marker saying how far it has been flushed
+Each process holds a lock on its own segments, so logs nobody holds belong to a process that died and their
+unflushed picks are replayed by the next process that starts, a crash mid flush can store a pick twice
+A batch postgres can not take for any other reason than being unavailable is written pick by pick, the picks
+it still refuses are appended to dead-letter.jsonl in PICK_LOG_DIR so they never block the picks behind them
+Example: pick_buffer.append('walle', 'candy bar')
+'''
+class PickBuffer:
+    def __init__(self, log_dir, flush_size, flush_interval, max_size, fsync):
+        self.log_dir = log_dir
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.fsync = fsync
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._started = PerProcess(self._start)
+        """ [file, seq of its last pick] of every segment not flushed yet, oldest first, picks go to the last one """
+        self._segments = deque()
+        self._seq = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.replayed = 0
+        self.flushed = 0
+        self.batches = 0
+        self.failures = 0
+        self.dead_lettered = 0
+        self.last_error = None
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.flush_seconds_total = 0.0
+
+    def _start(self):
+        """ Every worker process writes its own log """
+        self._cond = threading.Condition()
+        with self._cond:
+            """ A forked worker lets go of the parent's segments, the lock goes with the last process that closes them """
+            for f, _ in self._segments:
+                f.close()
+            self._segments = deque()
+            os.makedirs(self.log_dir, exist_ok=True)
+            self._new_segment()
+            self._queue = deque()
+            self._seq = 0
+            self._recover()
+        threading.Thread(target=self._flush_loop, name='pick-flusher', daemon=True).start()
+
+    def _new_segment(self):
+        """ The time in the name keeps it unique even for a later process with our pid, PID 1 in a container every time """
+        f = open(os.path.join(self.log_dir, f"picks-{os.getpid()}-{time.time_ns()}.log"), 'a')
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._segments.append([f, 0])
+
+    def _recover(self):
+        for name in sorted(os.listdir(self.log_dir)):
+            path = os.path.join(self.log_dir, name)
+            if not name.endswith('.log') or path == self._segments[-1][0].name:
+                continue
+            with open(path) as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                """ Another process may have replayed and removed it between our open and our lock """
+                if not os.path.exists(path) or os.stat(path).st_ino != os.fstat(f.fileno()).st_ino:
+                    continue
+                entries = []
+                flushed = 0
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        """ A torn last line from a crash mid write, the pick never got its 200 """
+                        continue
+                    if 'flushed' in record:
+                        flushed = max(flushed, record['flushed'])
+                    else:
+                        entries.append(record)
+                for record in entries:
+                    if record['seq'] > flushed:
+                        self._enqueue(record['robot_name'], record['item_name'], record['pick_timestamp'])
+                        self.replayed += 1
+                os.remove(path)
+        if self.replayed:
+            print("replayed " + str(self.replayed) + " buffered picks from " + self.log_dir)
+
+    def _write_log(self, f, record):
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def _enqueue(self, robot_name, item_name, pick_timestamp):
+        self._seq += 1
+        self._write_log(self._segments[-1][0], {'seq': self._seq, 'robot_name': robot_name, 'item_name': item_name, 'pick_timestamp': pick_timestamp})
+        self._segments[-1][1] = self._seq
+        self._queue.append((self._seq, robot_name, item_name, pick_timestamp, time.monotonic()))
+        """ Wake the flusher for the first pick of a batch and for a full batch, in between it waits on its own """
+        if len(self._queue) == 1 or len(self._queue) >= self.flush_size:
+            self._cond.notify()
+
+    def append(self, robot_name, item_name):
+        """ Returns False when the buffer is full so the caller can push back instead of growing without bound """
+        self._started.ensure()
+        pick_timestamp = datetime.utcnow().isoformat()
+        with self._cond:
+            if len(self._queue) >= self.max_size:
+                self.rejected += 1
+                return False
+            self._enqueue(robot_name, item_name, pick_timestamp)
+            self.accepted += 1
+            return True
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            deadline = self._queue[0][4] + self.flush_interval
+            while len(self._queue) < self.flush_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return list(itertools.islice(self._queue, self.flush_size))
+
+    def _write(self, batch):
+        conn = db_pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                write_picks(cur, [(robot_name, item_name, datetime.fromisoformat(ts)) for _, robot_name, item_name, ts, _ in batch])
+        finally:
+            db_pool.putconn(conn)
+
+    def _write_one_by_one(self, batch):
+        """ Something in the batch postgres will never take, picks are written one at a time and the ones it refuses
+        go to the dead letter file instead of holding up every pick behind them, returns how many were dealt with """
+        for done, entry in enumerate(batch):
+            try:
+                self._write([entry])
+            except PICK_TRANSIENT_ERRORS:
+                return done
+            except Exception as e:
+                seq, robot_name, item_name, pick_timestamp, _ = entry
+                with open(os.path.join(self.log_dir, 'dead-letter.jsonl'), 'a') as f:
+                    f.write(json.dumps({'seq': seq, 'robot_name': robot_name, 'item_name': item_name, 'pick_timestamp': pick_timestamp, 'error': repr(e)}) + '\n')
+                with self._cond:
+                    self.dead_lettered += 1
+                print("moved pick " + str(seq) + " to the dead letter file: " + repr(e))
+        return len(batch)
+
+    def _rotate(self, flushed):
+        """ Called with every pick up to seq flushed in postgres, so the log only ever holds the last few flush windows """
+        if self._segments[-1][1]:
+            self._new_segment()
+        while self._segments[0][1] and self._segments[0][1] <= flushed:
+            f, _ = self._segments.popleft()
+            os.remove(f.name)
+            f.close()
+        """ Picks are flushed in order, only the oldest segment left can be partly flushed """
+        if self._segments[0][1]:
+            self._write_log(self._segments[0][0], {'flushed': flushed})
+
+    def _flush_loop(self):
+        while True:
+            batch = self._next_batch()
+            t0 = time.monotonic()
+            dead_lettered = self.dead_lettered
+            try:
+                self._write(batch)
+                done = len(batch)
+            except PICK_TRANSIENT_ERRORS as e:
+                done = 0
+                error = e
+            except Exception as e:
+                done = self._write_one_by_one(batch)
+                error = e
+            elapsed = time.monotonic() - t0
+
+            with self._cond:
+                for _ in range(done):
+                    self._queue.popleft()
+                if done:
+                    self._rotate(batch[done - 1][0])
+                if done < len(batch):
+                    """ Keep the rest of the batch and try again, postgres may be failing over """
+                    self.failures += 1
+                    self.last_error = repr(error)
+                else:
+                    self.failures = 0
+                self.flushed += done - (self.dead_lettered - dead_lettered)
+                self.batches += 1
+                self.last_flush_seconds = elapsed
+                self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+                self.flush_seconds_total += elapsed
+                failures = self.failures
+            if done < len(batch):
+                time.sleep(min(2 ** min(failures, 5), 30))
+
+    def stats(self):
+        with self._cond:
+            return {
+                'enabled': PICK_WRITE_BEHIND,
+                'depth': len(self._queue),
+                'max_size': self.max_size,
+                'oldest_seconds': time.monotonic() - self._queue[0][4] if self._queue else 0.0,
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'replayed': self.replayed,
+                'flushed': self.flushed,
+                'batches': self.batches,
+                'failures': self.failures,
+                'dead_lettered': self.dead_lettered,
+                'log_segments': len(self._segments),
+                'last_error': self.last_error,
+                'last_flush_seconds': self.last_flush_seconds,
+                'max_flush_seconds': self.max_flush_seconds,
+                'avg_flush_seconds': self.flush_seconds_total / self.batches if self.batches else 0.0,
+            }
+
+pick_buffer = PickBuffer(PICK_LOG_DIR, PICK_FLUSH_SIZE, PICK_FLUSH_INTERVAL, PICK_BUFFER_MAX, PICK_LOG_FSYNC)
+if PICK_WRITE_BEHIND:
+    """ Start right away so picks a previous process left behind are replayed without waiting for a new pick """
+    pick_buffer._started.ensure()
+
+'''
+pick_buffer_stats() reports how many picks are waiting to be written and how long flushes take
+Example: https://www.simtooreal.com/pick/buffer
+Output: {"depth": 12, "oldest_seconds": 0.2, "last_flush_seconds": 0.011, ...}
+'''
+@app.route('/pick/buffer')
+def pick_buffer_stats():
+    return pick_buffer.stats()
+
+""" The rollups /stats can read, kept up to date by the count_new_picks trigger in schema.sql """
+STATS_ROLLUPS = {
+    'robots': ('public.pick_counts_robot_hour', 'public.robots', 'robot_id', 'robot_name'),
+    'items': ('public.pick_counts_item_hour', 'public.items', 'item_id', 'item_name'),
+}
+STATS_BUCKETS = ('hour', 'day', 'week', 'month', 'total')
+STATS_LIMIT_MAX = int(os.environ.get('STATS_LIMIT_MAX', 1000))
+
+'''
+stats() answers questions like picks per robot per hour or top items today from the hourly rollups only,
+so it costs the same at a billion picks as at a thousand
+kind is robots or items (/stats?by= works too), since and until are ISO timestamps (default the last 24 hours, rounded down to
+the hour), bucket is hour, day, week, month or total, name keeps a single robot or item and limit caps the rows
+With bucket=total the rows are the busiest robots or items first
+Example: https://www.simtooreal.com/stats/items?bucket=total&since=2022-04-01&limit=10
+Output: {"kind": "items", "bucket": "total", "rows": [{"item_name": "candy bar", "picks": 1200}, ...]}
+'''
+@app.route('/stats')
+@app.route('/stats/<kind>')
+def stats(kind=None):
+    if kind is None:
+        kind = request.args.get('by', 'robots')
+    if kind not in STATS_ROLLUPS:
+        return jsonify(error="kind must be one of " + ", ".join(STATS_ROLLUPS)), 404
+    rollup, names, id_column, name_column = STATS_ROLLUPS[kind]
+
+    bucket = request.args.get('bucket', 'hour')
+    if bucket not in STATS_BUCKETS:
+        return jsonify(error="bucket must be one of " + ", ".join(STATS_BUCKETS)), 400
+    try:
+        until = datetime.fromisoformat(request.args['until']) if 'until' in request.args else datetime.utcnow()
+        since = datetime.fromisoformat(request.args['since']) if 'since' in request.args else until - timedelta(days=1)
+    except ValueError:
+        return jsonify(error="since and until must be ISO 8601 timestamps"), 400
+    limit = max(1, min(request.args.get('limit', STATS_LIMIT_MAX, type=int), STATS_LIMIT_MAX))
+    params = {'since': since, 'until': until, 'bucket': bucket, 'limit': limit, 'name': request.args.get('name')}
+
+    name_filter = f"AND n.{name_column} = %(name)s" if params['name'] is not None else ""
+    if bucket == 'total':
+        query = f"SELECT n.{name_column}, sum(c.picks) FROM {rollup} c JOIN {names} n USING ({id_column}) WHERE c.bucket >= date_trunc('hour', %(since)s::timestamp) AND c.bucket < %(until)s {name_filter} GROUP BY 1 ORDER BY 2 DESC, 1 LIMIT %(limit)s;"
+    else:
+        query = f"SELECT n.{name_column}, date_trunc(%(bucket)s, c.bucket), sum(c.picks) FROM {rollup} c JOIN {names} n USING ({id_column}) WHERE c.bucket >= date_trunc('hour', %(since)s::timestamp) AND c.bucket < %(until)s {name_filter} GROUP BY 1, 2 ORDER BY 2, 3 DESC, 1 LIMIT %(limit)s;"
+
+    cur = get_db().cursor()
+    cur.execute(query, params)
+    if bucket == 'total':
+        rows = [{name_column: name, 'picks': int(picks)} for name, picks in cur.fetchall()]
+    else:
+        rows = [{name_column: name, 'bucket': b.isoformat(), 'picks': int(picks)} for name, b, picks in cur.fetchall()]
+    cur.close()
+
+    return jsonify(kind=kind, bucket=bucket, since=since.isoformat(), until=until.isoformat(), rows=rows)
+
+""" Dashboard paging, pages are never larger than DASHBOARD_PAGE_SIZE_MAX rows """
+DASHBOARD_PAGE_SIZE = int(os.environ.get('DASHBOARD_PAGE_SIZE', 50))
+DASHBOARD_PAGE_SIZE_MAX = int(os.environ.get('DASHBOARD_PAGE_SIZE_MAX', 500))
+DASHBOARD_ITERSIZE = int(os.environ.get('DASHBOARD_ITERSIZE', 100))
+
+""" The tables the dashboard can show, in the order it shows them, with the key it pages on """
+DASHBOARD_TABLES = OrderedDict([
+    ('robots', ('public.robots', 'robot_id', 'Robots')),
+    ('items', ('public.items', 'item_id', 'Items')),
+    ('picks', ('public.picks', 'pick_id', 'Picks')),
+    ('questions', ('public.questions', 'data_id', 'Questions')),
+    ('categories', ('public.categories', 'data_id', 'Categories')),
+])
+
+'''
+stream_rows() takes a connection, a query and its parameters and yields rows from a server side (named)
+cursor, so only DASHBOARD_ITERSIZE rows are held in memory at a time however many the query matches
+Named cursors need a transaction so autocommit is switched off while the rows are read and switched back after
+Example: for row in stream_rows(get_db(), "SELECT * FROM public.robots;", {}): ...
+'''
+def stream_rows(conn, query, params):
+    conn.autocommit = False
+    try:
+        with conn.cursor(name='stream_rows') as cur:
+            cur.itersize = DASHBOARD_ITERSIZE
+            cur.execute(query, params)
+            for row in cur:
+                yield row
+    finally:
+        conn.rollback()
+        conn.autocommit = True
+
+'''
+page_size() reads the limit query argument and keeps it between 1 and DASHBOARD_PAGE_SIZE_MAX
+Example: https://www.simtooreal.com/table/picks?limit=100000
+Output: 500
+'''
+def page_size():
+    limit = request.args.get('limit', DASHBOARD_PAGE_SIZE, type=int)
+    return max(1, min(limit, DASHBOARD_PAGE_SIZE_MAX))
+
+'''
+page_query() is the keyset query for one page of a dashboard table and its parameters
+One row more than the page is asked for, it only tells us there is a next page
+'''
+def page_query(name, after, limit):
+    table, id_column, _ = DASHBOARD_TABLES[name]
+    return f"SELECT * FROM {table} WHERE {id_column} > %(after)s ORDER BY {id_column} LIMIT %(limit)s;", {'after': after, 'limit': limit + 1}
+
+'''
+render_rows() yields the rows of one page of a dashboard table as html and a link to the next page when there is one
+'''
+def render_rows(name, rows, limit):
+    yield "<br/><br/><h3>Indices and " + DASHBOARD_TABLES[name][2] + "</h3><br/><br/>"
+    last_id = None
+    shown = 0
+    more = False
+    for r in rows:
+        if shown == limit:
+            more = True
+            continue
+        shown += 1
+        last_id = r[0]
+        yield str(r)[1:-1] + '<br/>'
+
+    if more:
+        yield f'<a href="/table/{name}?after={last_id}&limit={limit}">next page</a><br/>'
+
+'''
+render_table_page() yields one keyset paginated page of a dashboard table as html, a row at a time
+The page holds the rows whose key is greater than after and ends with a link to the next page
+Example: "".join(render_table_page(get_db(), 'picks', after=0, limit=2))
+Output: <br/><br/><h3>Indices and Picks</h3><br/><br/>1, datetime.datetime(...), 1, 1<br/>2, ...<br/><a href="/table/picks?after=2&limit=2">next page</a><br/>
+'''
+def render_table_page(conn, name, after=0, limit=DASHBOARD_PAGE_SIZE):
+    query, params = page_query(name, after, limit)
+    if name in snapshots:
+        """ A page is at most DASHBOARD_PAGE_SIZE_MAX rows, small enough to keep a copy of """
+        with conn.cursor() as cur:
+            rows = snapshots.rows(cur, name, query, params)
+    else:
+        rows = stream_rows(conn, query, params)
+    yield from render_rows(name, rows, limit)
+
+'''
+read_table_page() returns the rows of one page of a dashboard table, on a pooled connection of its own
+so the pages of the dashboard can be read at the same time
+Example: read_table_page('picks', 0, 50)
+'''
+def read_table_page(name, after, limit):
+    query, params = page_query(name, after, limit)
+    return read_rows(name, query, params)
+
+'''
+read_rows() runs a query on a connection it borrows from the pool and hands straight back, a table with a snapshot
+is only read when the snapshot is missing, so a streamed response never holds a connection between its reads
+Example: read_rows('categories', "SELECT * FROM public.categories;")
+Output: [('Shipping',), ('Omnichannel',), ...]
+'''
+def read_rows(name, query, params=None):
+    if name in snapshots:
+        rows = snapshots.get(name, query, params)
+        if rows is not None:
+            return rows
+    conn = db_pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            if name in snapshots:
+                return snapshots.fetch(cur, name, query, params)
+            cur.execute(query, params)
+            return cur.fetchall()
+    finally:
+        db_pool.putconn(conn)
+
+""" How many dashboard pages of all requests in a process are read from postgres at the same time """
+DASHBOARD_CONCURRENCY = int(os.environ.get('DASHBOARD_CONCURRENCY', 5))
+dashboard_readers = PerProcess(lambda: ThreadPoolExecutor(DASHBOARD_CONCURRENCY, thread_name_prefix='dashboard'))
+
+'''
+render_dashboard() yields the first page of every dashboard table
+The pages are read at the same time and sent in order, so the slowest table and not the sum of them sets the wait
+'''
+def render_dashboard(limit=DASHBOARD_PAGE_SIZE):
+    pages = [dashboard_readers.ensure().submit(read_table_page, name, 0, limit) for name in DASHBOARD_TABLES]
+    for name, page in zip(DASHBOARD_TABLES, pages):
+        yield from render_rows(name, page.result(), limit)
+
+'''
+table_page() streams one page of a single dashboard table
+Example: https://www.simtooreal.com/table/picks?after=1000&limit=100
+Output: the picks with a pick_id after 1000, 100 of them, and a link to the next page
+'''
+@app.route('/table/<name>')
+def table_page(name):
+    if name not in DASHBOARD_TABLES:
+        return "There is no table called " + name, 404
+    after = request.args.get('after', 0, type=int)
+    limit = page_size()
+
+    """ The connection is borrowed inside the stream, Flask 2.1 keeps the request context until the stream ends
+    and later versions tear the view's context down before it starts, borrowing here is right with both """
+    def generate():
+        yield from render_table_page(get_db(), name, after, limit)
+
+    return Response(stream_with_context(generate()))
+
+""" The few shot prompt GPT-3 gets in front of every question """
+GPT_PROMPT = "Instruction: Given an input question, respond with syntactically correct PostgreSQL. Be creative but the SQL must be correct. Only use tables called \"robots\", \"items\", and \"picks\". The \"robots\" table has columns: robot_id (integer), and robot_name (character varying). The \"items\" table has columns: item_id (integer), and item_name (character varying). The \"picks\" table has columns: pick_id (integer), pick_timestamp (timestamp), robot_id (foreign key integer), and item_id (foreign key integer).\nUser: How many robots are there?\nGPT: SELECT COUNT(*) FROM robots\nUser: What is the most recently picked item?\nGPT: SELECT max(pick_timestamp) FROM picks\nUser: What is the robot with the latest pick?\nGPT: SELECT * FROM picks WHERE pick_timestamp = max(pick_timestamp)\nUser: What robots picked the item_name doll?\nGPT: SELECT r.robot_name,p.pick_timestamp FROM public.picks p JOIN public.robots r ON p.robot_id=r.robot_id JOIN public.items i ON p.item_id=i.item_id WHERE i.item_name='doll';\nUser: What items were picked by the robot optimus?\nGPT: SELECT i.item_name,p.pick_timestamp FROM public.picks p JOIN public.robots r ON p.robot_id=r.robot_id JOIN public.items i ON p.item_id=i.item_id WHERE r.robot_name='optimus';\nUser: What robots picked the item sandwich?\nGPT: SELECT r.robot_name,p.pick_timestamp FROM public.picks p JOIN public.robots r ON p.robot_id=r.robot_id JOIN public.items i ON p.item_id=i.item_id WHERE i.item_name='sandwich';\nUser: "
+
+""" Completion parameters, they are part of the cache key so changing any of them starts a fresh cache """
+GPT_PARAMS = {
+    'engine': "davinci-instruct-beta",
+    'temperature': 0.3,
+    'max_tokens': 303,
+    'top_p': 1,
+    'frequency_penalty': 0.2,
+    'presence_penalty': 0,
+    'stop': ["\n"],
+}
+
+""" Translation cache settings, the sqlite file is shared by every worker on the host """
+GPT_CACHE_PATH = os.environ.get('GPT_CACHE_PATH', 'gpt_cache.sqlite3')
+GPT_CACHE_SIZE = int(os.environ.get('GPT_CACHE_SIZE', 10000))
+GPT_CACHE_TTL = float(os.environ.get('GPT_CACHE_TTL', 7 * 86400))
+GPT_CACHE_TOUCH_INTERVAL = float(os.environ.get('GPT_CACHE_TOUCH_INTERVAL', 600))
+
+'''
+OpenAICompletionClient asks the completion API to continue a prompt and returns the text of the first choice
+Anything with the same complete(prompt, **params) method can stand in for it, for example a local fake of
+the completion service when testing, and OPENAI_API_BASE points this client at another server
+Example: OpenAICompletionClient().complete(GPT_PROMPT + "How many robots are there?\\n", **GPT_PARAMS)
+Output: GPT: SELECT COUNT(*) FROM robots
+'''
+class OpenAICompletionClient:
+    def __init__(self, api_base=None):
+        self.api_base = api_base
+
+    def complete(self, prompt, **params):
+        import openai
+        openai.api_key = os.environ["OPENAI_API_KEY"]
+        if self.api_base:
+            params['api_base'] = self.api_base
+        with completion_seconds.time():
+            gpt_result = openai.Completion.create(prompt=prompt, **params)
+        return gpt_result["choices"][0]["text"]
+
+'''
+normalize_translation() only collapses whitespace, the answer quotes names from the question and postgres compares them with case
+Example: normalize_translation("  What robots picked   the item Doll? ")
+Output: What robots picked the item Doll?
+'''
+def normalize_translation(text):
+    return ' '.join(text.split())
+
+'''
+TranslationCache remembers what the completion API answered for a question in a local sqlite file
+The key is the question with its whitespace collapsed together with the prompt and parameters, the least recently used
+answers are evicted beyond max_size and answers older than ttl seconds are asked for again
+Identical questions that arrive while the first one is still waiting on the API share that one call
+Example: TranslationCache(OpenAICompletionClient(), 'gpt_cache.sqlite3').translate('How many robots are there?')
+Output: GPT: SELECT COUNT(*) FROM robots
+'''
+class TranslationCache:
+    def __init__(self, client, path, max_size=GPT_CACHE_SIZE, ttl=GPT_CACHE_TTL, prompt=GPT_PROMPT, params=GPT_PARAMS, touch_interval=GPT_CACHE_TOUCH_INTERVAL):
+        self.client = client
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.touch_interval = touch_interval
+        self.prompt = prompt
+        self.params = params
+        self._lock = threading.Lock()
+        self._db = PerProcess(self._open)
+        self._in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def _open(self):
+        db = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+        db.execute("PRAGMA journal_mode=WAL;")
+        db.execute("CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, question TEXT NOT NULL, answer TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL);")
+        db.execute("CREATE INDEX IF NOT EXISTS translations_last_used ON translations (last_used);")
+        db.commit()
+        return db
+
+    def key(self, question):
+        """ Keys used to be a list with the lowercased question, a dict never hashes to one of those stale answers """
+        key = {'question': normalize_translation(question), 'prompt': self.prompt, 'params': self.params}
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def _lookup(self, key):
+        with self._lock:
+            db = self._db.ensure()
+            row = db.execute("SELECT answer, created, last_used FROM translations WHERE key = ?;", (key,)).fetchone()
+            now = time.time()
+            if row is None or now - row[1] > self.ttl:
+                return None
+            if now - row[2] > self.touch_interval:
+                """ A hit is a plain read, last_used only needs to be roughly right to pick what to evict,
+                so it is written at most once per touch_interval instead of taking the write lock on every hit """
+                db.execute("UPDATE translations SET last_used = ? WHERE key = ?;", (now, key))
+                db.commit()
+            return row[0]
+
+    def _save(self, key, question, answer):
+        with self._lock:
+            db = self._db.ensure()
+            now = time.time()
+            db.execute("INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?);", (key, question, answer, now, now))
+            evicted = db.execute("DELETE FROM translations WHERE key IN (SELECT key FROM translations ORDER BY last_used DESC LIMIT -1 OFFSET ?);", (self.max_size,)).rowcount
+            db.commit()
+            self.evictions += evicted
+
+    def translate(self, question, timeout=None):
+        """ Waits at most timeout seconds, a call that takes longer still stores its answer for the next asker """
+        key = self.key(question)
+        answer = self._lookup(key)
+        if answer is not None:
+            with self._lock:
+                self.hits += 1
+            return answer
+
+        """ The first request for a key asks the API, the ones that arrive meanwhile wait for its answer """
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if leader:
+            threading.Thread(target=self._ask, args=(key, question, future), name='completion', daemon=True).start()
+        return future.result(timeout)
+
+    def _ask(self, key, question, future):
+        try:
+            answer = self.client.complete(self.prompt + question + "\n", **self.params)
+            self._save(key, question, answer)
+            future.set_result(answer)
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            size = self._db.ensure().execute("SELECT COUNT(*) FROM translations;").fetchone()[0]
+            return {
+                'size': size,
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'in_flight': len(self._in_flight),
+                'hit_ratio': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            }
+
+translator = TranslationCache(OpenAICompletionClient(os.environ.get('OPENAI_API_BASE')), GPT_CACHE_PATH)
+
 '''
 gpt() takes no arguments but uses form data to ask GPT-3 to translate text to SQL queries
 '''
@@ -100,78 +1731,219 @@ def gpt():
         human = str(request.form['Human'])
         text = "<h4>You asked GPT-3: " + human + "</h4>"
 
-        openai.api_key = os.environ["OPENAI_API_KEY"]
+        """ Now we have what we need to ask GPT-3 to make SQL queries for us, a question asked before is answered from the cache """
+        try:
+            answer = translator.translate(human, timeout=time_left())
+        except FutureTimeoutError:
+            return "GPT-3 did not answer in time, try again shortly", 504
 
-        # start_sequence = "\nGPT:"
-        # restart_sequence = "\nUser: "
+        text += "<h4>GPT-3 Says: " + answer.replace("GPT: ","") + "</h4>"
 
-        """ Now we have what we need to ask GPT-3 to make SQL queries for us """
-        gpt_result = openai.Completion.create(
-            engine="davinci-instruct-beta",
-            prompt="Instruction: Given an input question, respond with syntactically correct PostgreSQL. Be creative but the SQL must be correct. Only use tables called \"robots\", \"items\", and \"picks\". The \"robots\" table has columns: robot_id (integer), and robot_name (character varying). The \"items\" table has columns: item_id (integer), and item_name (character varying). The \"picks\" table has columns: pick_id (integer), pick_timestamp (timestamp), robot_id (foreign key integer), and item_id (foreign key integer).\nUser: How many robots are there?\nGPT: SELECT COUNT(*) FROM robots\nUser: What is the most recently picked item?\nGPT: SELECT max(pick_timestamp) FROM picks\nUser: What is the robot with the latest pick?\nGPT: SELECT * FROM picks WHERE pick_timestamp = max(pick_timestamp)\nUser: What robots picked the item_name doll?\nGPT: SELECT r.robot_name,p.pick_timestamp FROM public.picks p JOIN public.robots r ON p.robot_id=r.robot_id JOIN public.items i ON p.item_id=i.item_id WHERE i.item_name='doll';\nUser: What items were picked by the robot optimus?\nGPT: SELECT i.item_name,p.pick_timestamp FROM public.picks p JOIN public.robots r ON p.robot_id=r.robot_id JOIN public.items i ON p.item_id=i.item_id WHERE r.robot_name='optimus';\nUser: What robots picked the item sandwich?\nGPT: SELECT r.robot_name,p.pick_timestamp FROM public.picks p JOIN public.robots r ON p.robot_id=r.robot_id JOIN public.items i ON p.item_id=i.item_id WHERE i.item_name='sandwich';\nUser: " + human + "\n",
-            temperature=0.3,
-            max_tokens=303,
-            top_p=1,
-            frequency_penalty=0.2,
-            presence_penalty=0,
-            stop=["\n"]
-        )
+        """ The answer goes out first and the tables follow page by page as they are read """
+        def generate():
+            yield text
+            yield from render_dashboard(page_size())
 
-        text += "<h4>GPT-3 Says: " + gpt_result["choices"][0]["text"].replace("GPT: ","") + "</h4>"
+        return Response(stream_with_context(generate()))
 
-        """ These are the postgres environment variables to avoid storing sensitive info in the github repo """
-        POSTGRESQL_HOST = os.environ.get('POSTGRESQL_HOST')
-        POSTGRESQL_USER_NAME = os.environ.get('POSTGRESQL_USER_NAME')
-        POSTGRESQL_PASSWORD = os.environ.get('POSTGRESQL_PASSWORD')
+""" Batch classification limits """
+QUESTION_BATCH_MAX = int(os.environ.get('QUESTION_BATCH_MAX', 100000))
+QUESTION_BATCH_CHUNK = int(os.environ.get('QUESTION_BATCH_CHUNK', 1000))
+QUESTION_TOP_K = int(os.environ.get('QUESTION_TOP_K', 3))
 
-        """ We use psycopg2 to create a database connection either locally or in AWS """
-        conn = psycopg2.connect(host=POSTGRESQL_HOST, port = 5432, database="simtooreal", user=POSTGRESQL_USER_NAME, password=POSTGRESQL_PASSWORD)
-        conn.autocommit=True
+'''
+top_categories() takes a classifier, a list of texts and k and returns the k best categories of every text
+All texts go through one vectorized decision_function call, a binary model's single column of scores is
+turned into one score per class so both kinds of model look the same to the caller
+Example: top_categories(clf, ['where is my order?'], 2)
+Output: [[{'category': 'Shipping', 'score': 1.21}, {'category': 'Omnichannel', 'score': -0.87}]]
+'''
+def top_categories(clf, texts, k):
+    with model_predict_seconds.time(kind='batch'):
+        scores = clf.decision_function(texts)
+    if scores.ndim == 1:
+        scores = numpy.column_stack([-scores, scores])
+    classes = clf.classes_
+    k = min(k, len(classes))
+    best = numpy.argsort(-scores, axis=1)[:, :k]
+    return [[{'category': str(classes[j]), 'score': float(row_scores[j])} for j in row_best] for row_scores, row_best in zip(scores, best)]
 
-        """ Create a cursor object """
-        cur = conn.cursor()
+'''
+question_batch() takes a JSON list of texts, or an object with the list under "texts" and an optional "k",
+and answers with the top k categories and scores of every text in the same order
+The texts are scored QUESTION_BATCH_CHUNK at a time and the answer is streamed out chunk by chunk so
+a backlog of tens of thousands of questions never needs its whole score matrix in memory
+Example: curl -X POST https://www.simtooreal.com/question/batch -H 'Content-Type: application/json'
+    -d '{"texts": ["where is my order?", "do you price match?"], "k": 2}'
+Output: {"model_version": "3f2a9c1d0b7e", "results": [{"prediction": "Shipping", "top": [...]}, ...]}
+'''
+@app.route('/question/batch', methods=['POST'])
+def question_batch():
+    body = request.get_json(silent=True)
+    k = QUESTION_TOP_K
+    if isinstance(body, dict):
+        k = body.get('k', k)
+        body = body.get('texts')
+    if not isinstance(body, list) or not all(isinstance(text, str) for text in body):
+        return jsonify(error="expected a JSON list of texts or an object with a \"texts\" list"), 400
+    if len(body) > QUESTION_BATCH_MAX:
+        return jsonify(error=f"at most {QUESTION_BATCH_MAX} texts may be sent in one request"), 413
+    if not isinstance(k, int) or k < 1:
+        return jsonify(error="k must be a positive integer"), 400
 
-        """ A query that looks up all robots """
-        cur.execute("SELECT * FROM public.robots;")
-        row = cur.fetchall()
-        if row != None:
-            text += "<br/><br/><h3>Indices and Robots</h3><br/><br/>"
-            for r in row:
-                text += str(r)[1:-1] + '<br/>'
+    """ Hold on to one model for the whole batch even if a new one is swapped in half way """
+    clf, model_version = classifier.get()
 
-        """ A query that looks up all items """
-        cur.execute("SELECT * FROM public.items;")
-        row = cur.fetchall()
-        if row != None:
-            text += "<br/><br/><h3>Indices and Items</h3><br/><br/>"
-            for r in row:
-                text += str(r)[1:-1] + '<br/>'
+    def generate():
+        yield '{"model_version": ' + json.dumps(model_version) + ', "results": ['
+        for start in range(0, len(body), QUESTION_BATCH_CHUNK):
+            chunk = top_categories(clf, body[start:start + QUESTION_BATCH_CHUNK], k)
+            yield (',' if start else '') + ','.join(json.dumps({'prediction': top[0]['category'], 'top': top}) for top in chunk)
+        yield ']}'
 
-        """ A query that looks up all picks """
-        cur.execute("SELECT * FROM public.picks;")
-        row = cur.fetchall()
-        if row != None:
-            text += "<br/><br/><h3>Indices and Picks</h3><br/><br/>"
-            for r in row:
-                text += str(r)[1:-1] + '<br/>'
+    return Response(generate(), mimetype='application/json')
 
-        """ A query that looks up all questions """
-        cur.execute("SELECT * FROM public.questions;")
-        row = cur.fetchall()
-        if row != None:
-            text += "<br/><br/><h3>Indices and Questions</h3><br/><br/>"
-            for r in row:
-                text += str(r)[1:-1] + '<br/>'
+""" Answers of the classifier are remembered for repeated questions until the model changes """
+PREDICTION_CACHE_SIZE = int(os.environ.get('PREDICTION_CACHE_SIZE', 10000))
+PREDICTION_CACHE_TTL = float(os.environ.get('PREDICTION_CACHE_TTL', 3600))
+prediction_cache = LRUCache(PREDICTION_CACHE_SIZE, PREDICTION_CACHE_TTL)
+classifier.on_load.append(prediction_cache.clear)
 
-        """ A query that looks up all categories """
-        cur.execute("SELECT * FROM public.categories;")
-        row = cur.fetchall()
-        if row != None:
-            text += "<br/><br/><h3>Indices and Categories</h3><br/><br/>"
-            for r in row:
-                text += str(r)[1:-1] + '<br/>'
+'''
+normalize_question() folds case and whitespace, the vectorizer ignores both so the prediction can not change
+Example: normalize_question("  Where is   my ORDER? ")
+Output: where is my order?
+'''
+def normalize_question(text):
+    return ' '.join(text.lower().split())
+
+""" Micro-batching of /question, questions arriving together are scored by one predict call """
+PREDICT_BATCHING = os.environ.get('PREDICT_BATCHING', 'True') == 'True'
+PREDICT_BATCH_SIZE = int(os.environ.get('PREDICT_BATCH_SIZE', 64))
+PREDICT_BATCH_WAIT = float(os.environ.get('PREDICT_BATCH_WAIT', 0))
+
+'''
+PredictionBatcher hands questions from concurrent requests to one worker thread that scores them together
+The worker takes every waiting question, up to PREDICT_BATCH_SIZE, so questions that arrive while a batch
+is being scored make up the next one and a lone question is not delayed at all, under load one vectorized
+predict answers many requests while the request threads only wait on their future
+PREDICT_BATCH_WAIT holds a batch open that many seconds after its first question to gather more of them
+Example: prediction, model_version = predict_batcher.predict('Where is my order?')
+'''
+class PredictionBatcher:
+    def __init__(self, max_size, max_wait):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._worker = PerProcess(self._start)
+        self.questions = 0
+        self.batches = 0
+        self.failures = 0
+        self.last_error = None
+        self.max_batch = 0
+
+    def _start(self):
+        """ Questions queued in the parent have nobody waiting for them in this process """
+        self._cond = threading.Condition()
+        self._queue = deque()
+        threading.Thread(target=self._work, name='predict-batcher', daemon=True).start()
+
+    def predict(self, text):
+        """ Returns the category of text and the version of the model that chose it """
+        self._worker.ensure()
+        future = Future()
+        with self._cond:
+            self._queue.append((text, future, time.monotonic()))
+            if len(self._queue) == 1 or len(self._queue) >= self.max_size:
+                self._cond.notify()
+        return future.result()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            deadline = self._queue[0][2] + self.max_wait
+            while len(self._queue) < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return [self._queue.popleft() for _ in range(min(self.max_size, len(self._queue)))]
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            started = time.monotonic()
+            for _, _, enqueued in batch:
+                predict_queue_seconds.observe(started - enqueued)
+            predict_batch_size.observe(len(batch))
+            try:
+                clf, model_version = classifier.get()
+                with model_predict_seconds.time(kind='micro'):
+                    predictions = clf.predict([text for text, _, _ in batch])
+            except Exception as e:
+                """ Every request of the batch gets the error, the next batch tries again """
+                with self._cond:
+                    self.failures += 1
+                    self.last_error = repr(e)
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), prediction in zip(batch, predictions):
+                future.set_result((prediction, model_version))
+            with self._cond:
+                self.questions += len(batch)
+                self.batches += 1
+                self.max_batch = max(self.max_batch, len(batch))
+
+    def stats(self):
+        with self._cond:
+            return {
+                'enabled': PREDICT_BATCHING,
+                'max_size': self.max_size,
+                'max_wait': self.max_wait,
+                'depth': len(self._queue),
+                'questions': self.questions,
+                'batches': self.batches,
+                'avg_batch': self.questions / self.batches if self.batches else 0.0,
+                'max_batch': self.max_batch,
+                'failures': self.failures,
+                'last_error': self.last_error,
+            }
+
+predict_batcher = PredictionBatcher(PREDICT_BATCH_SIZE, PREDICT_BATCH_WAIT)
 
-        return text
+'''
+predict_batcher_stats() reports how many /question predictions were scored together
+Example: https://www.simtooreal.com/question/batcher
+Output: {"questions": 5120, "batches": 391, "avg_batch": 13.1, "max_batch": 64, ...}
+'''
+@app.route('/question/batcher')
+def predict_batcher_stats():
+    return predict_batcher.stats()
+
+'''
+predict_category() classifies one question, repeats of a question skip vectorization and inference
+The model version is part of the key so an answer from an old model is never served
+Questions that miss the cache are scored in a micro-batch with whatever other requests are asking at the same time
+Example: predict_category('Where is my order?')
+Output: Shipping
+'''
+def predict_category(human):
+    clf, model_version = classifier.get()
+    key = (model_version, normalize_question(human))
+    prediction = prediction_cache.get(key)
+    if prediction is None:
+        if PREDICT_BATCHING:
+            """ The batch may have used a newer model, its answer is remembered under that model's version """
+            prediction, model_version = predict_batcher.predict(human)
+            key = (model_version, key[1])
+        else:
+            with model_predict_seconds.time(kind='single'):
+                prediction = clf.predict([human])[0]
+        prediction_cache.put(key, prediction)
+    return prediction
 
 '''
 question() takes no arguments but uses form data to ask sklearn to translate a question to a category
@@ -182,24 +1954,10 @@ def question():
         human = str(request.form['Human'])
         text = "<h4>You asked sklearn: " + human + "</h4>"
 
-        clf = load('clf.joblib')
-
-        text += "<h4>sklearn Says: " + clf.predict([human])[0] + "</h4>"
-
-        """ These are the postgres environment variables to avoid storing sensitive info in the github repo """
-        POSTGRESQL_HOST = os.environ.get('POSTGRESQL_HOST')
-        POSTGRESQL_USER_NAME = os.environ.get('POSTGRESQL_USER_NAME')
-        POSTGRESQL_PASSWORD = os.environ.get('POSTGRESQL_PASSWORD')
-
-        """ We use psycopg2 to create a database connection either locally or in AWS """
-        conn = psycopg2.connect(host=POSTGRESQL_HOST, port = 5432, database="simtooreal", user=POSTGRESQL_USER_NAME, password=POSTGRESQL_PASSWORD)
-        conn.autocommit=True
-
-        """ Create a cursor object """
-        cur = conn.cursor()
+        text += "<h4>sklearn Says: " + predict_category(human) + "</h4>"
 
-        cur.execute("SELECT * FROM public.categories;")
-        row = cur.fetchall()
+        """ The connection goes back to the pool before the dashboard streams, its pages borrow their own """
+        row = read_rows('categories', "SELECT * FROM public.categories;")
         if row != None:
             text += "<h4>If you could choose a category what would you choose?</h4>"
             cat_dict = {}
@@ -208,47 +1966,12 @@ def question():
 
             text += render_template('feedback.html', categories = cat_dict)
 
-        """ A query that looks up all robots """
-        cur.execute("SELECT * FROM public.robots;")
-        row = cur.fetchall()
-        if row != None:
-            text += "<br/><br/><h3>Indices and Robots</h3><br/><br/>"
-            for r in row:
-                text += str(r)[1:-1] + '<br/>'
-
-        """ A query that looks up all items """
-        cur.execute("SELECT * FROM public.items;")
-        row = cur.fetchall()
-        if row != None:
-            text += "<br/><br/><h3>Indices and Items</h3><br/><br/>"
-            for r in row:
-                text += str(r)[1:-1] + '<br/>'
-
-        """ A query that looks up all picks """
-        cur.execute("SELECT * FROM public.picks;")
-        row = cur.fetchall()
-        if row != None:
-            text += "<br/><br/><h3>Indices and Picks</h3><br/><br/>"
-            for r in row:
-                text += str(r)[1:-1] + '<br/>'
-
-        """ A query that looks up all questions """
-        cur.execute("SELECT * FROM public.questions;")
-        row = cur.fetchall()
-        if row != None:
-            text += "<br/><br/><h3>Indices and Questions</h3><br/><br/>"
-            for r in row:
-                text += str(r)[1:-1] + '<br/>'
-
-        """ A query that looks up all categories """
-        cur.execute("SELECT * FROM public.categories;")
-        row = cur.fetchall()
-        if row != None:
-            text += "<br/><br/><h3>Indices and Categories</h3><br/><br/>"
-            for r in row:
-                text += str(r)[1:-1] + '<br/>'
+        """ The answer goes out first and the tables follow page by page as they are read """
+        def generate():
+            yield text
+            yield from render_dashboard(page_size())
 
-        return text
+        return Response(stream_with_context(generate()))
 
 '''
 feedback() takes no arguments but uses form data to get data from customers
@@ -260,82 +1983,144 @@ def feedback():
         category = str(request.form['submit'])
         text += 'submitted ' + category
         
-        """ These are the postgres environment variables to avoid storing sensitive info in the github repo """
-        POSTGRESQL_HOST = os.environ.get('POSTGRESQL_HOST')
-        POSTGRESQL_USER_NAME = os.environ.get('POSTGRESQL_USER_NAME')
-        POSTGRESQL_PASSWORD = os.environ.get('POSTGRESQL_PASSWORD')
-
-        """ We use psycopg2 to create a database connection either locally or in AWS """
-        conn = psycopg2.connect(host=POSTGRESQL_HOST, port = 5432, database="simtooreal", user=POSTGRESQL_USER_NAME, password=POSTGRESQL_PASSWORD)
-        conn.autocommit=True
+        """ Borrow a connection from the shared pool, it is handed back when the request is torn down """
+        conn = get_db()
 
         """ Create a cursor object """
         cur = conn.cursor()
 
         """ Insert new feedback """
         cur.execute("INSERT INTO public.questions values(default,%(question_text)s,%(question_topic)s);", {'question_topic': category.split("category: ")[1], 'question_text': category.split("question: ")[1].split("category: ")[0]})
+        snapshots.changed(cur, 'questions')
     
     return text
 
 @app.route('/')
 def hello_world():
-    result = render_template('gpt.html')
-    result += render_template('question.html')
+    """ The forms go out straight away and the tables follow page by page as they are read """
+    def generate():
+        yield render_template('gpt.html')
+        yield render_template('question.html')
+        yield from render_dashboard(page_size())
 
-    """ These are the postgres environment variables to avoid storing sensitive info in the github repo """
-    POSTGRESQL_HOST = os.environ.get('POSTGRESQL_HOST')
-    POSTGRESQL_USER_NAME = os.environ.get('POSTGRESQL_USER_NAME')
-    POSTGRESQL_PASSWORD = os.environ.get('POSTGRESQL_PASSWORD')
+    return Response(stream_with_context(generate()))
 
-    """ We use psycopg2 to create a database connection either locally or in AWS """
-    conn = psycopg2.connect(host=POSTGRESQL_HOST, port = 5432, database="simtooreal", user=POSTGRESQL_USER_NAME, password=POSTGRESQL_PASSWORD)
-    conn.autocommit=True
 
-    """ Create a cursor object """
-    cur = conn.cursor()
+""" Start up settings, the model and the pool are warmed up in the background as soon as the app is imported """
+WARMUP = os.environ.get('WARMUP', 'True') == 'True'
+""" Whole seconds, it is also the connect_timeout of the /readyz probe and libpq takes no fractions """
+READY_DB_TIMEOUT = int(os.environ.get('READY_DB_TIMEOUT', 2))
+
+'''
+Warmup loads the classifier, scores one question with it and opens the connection pool on a background
+thread, so the process can answer /healthz right after import while the slow parts happen behind it
+/readyz only says yes once they are done, the load balancer sends traffic to an instance after that
+Example: warmup.start()
+'''
+class Warmup:
+    def __init__(self):
+        self._started = PerProcess(self._start)
+        self.started_at = None
+        self.finished_at = None
+        self.model_seconds = None
+        self.pool_seconds = None
+        self.last_error = None
+
+    def start(self):
+        """ Every worker process warms up its own pool """
+        self._started.ensure()
+
+    def _start(self):
+        self.started_at = time.time()
+        self.finished_at = None
+        threading.Thread(target=self._run, name='warmup', daemon=True).start()
+
+    def _run(self):
+        t0 = time.monotonic()
+        try:
+            clf, _ = classifier.get()
+            """ The first predict builds the analyzer and reads the coefficients into memory """
+            clf.predict(["Where is my order?"])
+            self.model_seconds = time.monotonic() - t0
+        except Exception as e:
+            """ The rest of the app still works without a model, /question will retry the load and /model shows why it failed """
+            classifier.last_error = repr(e)
+            self.last_error = "model " + type(e).__name__
+            print("could not load model from " + MODEL_PATH + ": " + classifier.last_error)
+        t0 = time.monotonic()
+        try:
+            db_pool.putconn(db_pool.getconn(timeout=READY_DB_TIMEOUT))
+            self.pool_seconds = time.monotonic() - t0
+        except Exception as e:
+            """ Requests and /readyz keep trying postgres by themselves """
+            self.last_error = "database " + type(e).__name__
+            print("could not open the connection pool: " + repr(e))
+        self.finished_at = time.time()
+        print("warm up finished in %0.3fs" % (self.finished_at - self.started_at) + (", " + self.last_error if self.last_error else ""))
+
+    def done(self):
+        """ Whether the first attempt is over, a failed one counts, with WARMUP off there is nothing to wait for """
+        return not WARMUP or self.finished_at is not None
 
-    """ A query that looks up all robots """
-    cur.execute("SELECT * FROM public.robots;")
-    row = cur.fetchall()
-    if row != None:
-        result += "<br/><br/><h3>Indices and Robots</h3><br/><br/>"
-        for r in row:
-            result += str(r)[1:-1] + '<br/>'
-
-    """ A query that looks up all items """
-    cur.execute("SELECT * FROM public.items;")
-    row = cur.fetchall()
-    if row != None:
-        result += "<br/><br/><h3>Indices and Items</h3><br/><br/>"
-        for r in row:
-            result += str(r)[1:-1] + '<br/>'
-
-    """ A query that looks up all picks """
-    cur.execute("SELECT * FROM public.picks;")
-    row = cur.fetchall()
-    if row != None:
-        result += "<br/><br/><h3>Indices and Picks</h3><br/><br/>"
-        for r in row:
-            result += str(r)[1:-1] + '<br/>'
-
-    """ A query that looks up all questions """
-    cur.execute("SELECT * FROM public.questions;")
-    row = cur.fetchall()
-    if row != None:
-        result += "<br/><br/><h3>Indices and Questions</h3><br/><br/>"
-        for r in row:
-            result += str(r)[1:-1] + '<br/>'
-
-    """ A query that looks up all categories """
-    cur.execute("SELECT * FROM public.categories;")
-    row = cur.fetchall()
-    if row != None:
-        result += "<br/><br/><h3>Indices and Categories</h3><br/><br/>"
-        for r in row:
-            result += str(r)[1:-1] + '<br/>'
-
-    return result
+    def stats(self):
+        return {
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'model_seconds': self.model_seconds,
+            'pool_seconds': self.pool_seconds,
+            'last_error': self.last_error,
+        }
 
+warmup = Warmup()
+
+@app.before_request
+def start_warmup():
+    """ A worker forked while its parent was still warming up (gunicorn --preload) has no warm up thread, it starts its own here """
+    if WARMUP:
+        warmup.start()
+
+'''
+healthz() answers as long as the process can serve requests at all, use it for liveness checks
+Example: https://www.simtooreal.com/healthz
+Output: ok
+'''
+@app.route('/healthz')
+def healthz():
+    return "ok"
+
+'''
+readyz() answers 503 until the first warm up attempt is over and 200 from then on, with the state of the model and postgres
+A missing model or an unreachable database is reported but does not make it fail, the app still takes picks and serves
+the dashboard without a model, write behind keeps accepting picks while postgres fails over, and the load balancer
+replacing every task over either would only make things worse
+Postgres is probed on a connection of its own with READY_DB_TIMEOUT as its connect timeout, so a full pool or a request
+stuck connecting through the pool never holds the check past the load balancer's timeout
+Example: https://www.simtooreal.com/readyz
+Output: {"ready": true, "model": "loaded", "database": "ok", "warmup": {"model_seconds": 1.9, ...}}
+'''
+@app.route('/readyz')
+def readyz():
+    database = "ok"
+    try:
+        conn = psycopg2.connect(**dict(db_pool.connect_kwargs, connect_timeout=READY_DB_TIMEOUT))
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+        finally:
+            conn.close()
+    except psycopg2.Error:
+        """ The error names hosts and sockets, only a short status goes out on this public endpoint """
+        database = "unreachable"
+    ready = warmup.done()
+    return jsonify(ready=ready, model="loaded" if classifier.loaded() else "not loaded", database=database, warmup=warmup.stats()), 200 if ready else 503
+
+""" python3 app.py in debug mode runs the app again in a child process, only that child needs to warm up """
+if WARMUP and not (__name__ == '__main__' and ASYNC_MODE != 'gevent' and os.environ.get('WERKZEUG_RUN_MAIN') != 'true'):
+    warmup.start()
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=8080)
+    if ASYNC_MODE == 'gevent':
+        from gevent.pywsgi import WSGIServer
+        WSGIServer(('0.0.0.0', 8080), app).serve_forever()
+    else:
+        app.run(debug=True, host='0.0.0.0', port=8080)
@@ -0,0 +1,253 @@
+"""
+This is a load testing and benchmark script for the flask app, unlike test.py it is meant for a local app.py
+
+It seeds robots, items and picks, then drives /pick, /question, /feedback and / with a chosen number of
+concurrent clients and mix of requests, and reports throughput and p50/p95/p99 latency per route.
+Results are written as JSON so two runs can be compared, --compare fails when p95 latency or throughput
+regressed by more than --tolerance against an earlier results file.
+
+Start a local postgres with docker-compose (docker-compose up database) or point POSTGRESQL_HOST at any
+postgres that has schema.sql loaded, then either run app.py yourself or let the script start it
+python3 bench.py --start-app --concurrency 16 --duration 30 --robots 50 --items 500 --seed-picks 100000
+python3 bench.py --url http://localhost:8080 --mix pick=80,question=10,feedback=5,index=5 --compare bench_results.json
+python3 bench.py --start-app --startup-runs 5 --duration 5 measures cold starts, the time until /healthz answers and until /readyz is ready
+"""
+from concurrent.futures import ThreadPoolExecutor
+import subprocess
+import threading
+import argparse
+import requests
+import random
+import json
+import time
+import sys
+import os
+
+ROUTES = ('pick', 'question', 'feedback', 'index')
+
+QUESTIONS = [
+    "Hi! If I sign up for your email list, can I select to get emails exclusively for sale products?",
+    "I'm going to be out of the country for about a month, can you ship there?",
+    "Is there a store near me that has this in stock?",
+    "Which of these two recliners is bigger?",
+    "How do I return a jacket that doesn't fit?",
+]
+CATEGORIES = ['Sales/Promotions', 'Shipping', 'Product Availability', 'Product Specifications', 'Omnichannel', 'Product Comparison', 'Returns & Refunds']
+
+
+def parse_mix(text):
+    """ pick=70,question=10 becomes {'pick': 70, 'question': 10} """
+    mix = {}
+    for part in text.split(','):
+        route, weight = part.split('=')
+        if route not in ROUTES:
+            raise argparse.ArgumentTypeError(route + " is not one of " + ", ".join(ROUTES))
+        mix[route] = float(weight)
+    return mix
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+
+def start_app(port):
+    """ Runs app.py with flask's threaded server, returns once /healthz answers and once /readyz says it is warm """
+    env = dict(os.environ, FLASK_APP='app')
+    app = subprocess.Popen([sys.executable, '-m', 'flask', 'run', '--port', str(port), '--with-threads'], env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    url = f"http://localhost:{port}"
+    t0 = time.time()
+    startup = None
+    while time.time() - t0 < 60:
+        try:
+            if startup is None:
+                requests.get(url + '/healthz', timeout=1)
+                startup = time.time() - t0
+            if requests.get(url + '/readyz', timeout=5).status_code == 200:
+                ready = time.time() - t0
+                print("app answered after %0.2fs and was ready after %0.2fs" % (startup, ready))
+                return app, url, startup, ready
+        except requests.exceptions.ConnectionError:
+            if app.poll() is not None:
+                raise Exception('app.py exited with status {}'.format(app.returncode))
+        time.sleep(0.05)
+    app.terminate()
+    raise Exception('app.py was not ready within 60 seconds')
+
+
+def measure_startup(port, runs):
+    """ Cold starts the app runs times and keeps the median time to answering and to being ready """
+    answered, ready = [], []
+    for _ in range(runs):
+        app, _, startup, warm = start_app(port)
+        app.terminate()
+        app.wait()
+        answered.append(startup)
+        ready.append(warm)
+    return sorted(answered)[len(answered) // 2], sorted(ready)[len(ready) // 2]
+
+
+def seed(session, url, robots, items, picks):
+    """ Creates every robot and item once and then adds random picks of them through /picks/bulk """
+    t0 = time.time()
+    records = [{'robot_name': robots[i % len(robots)], 'item_name': items[i % len(items)]} for i in range(max(len(robots), len(items)))]
+    records += [{'robot_name': random.choice(robots), 'item_name': random.choice(items)} for _ in range(max(0, picks - len(records)))]
+    for start in range(0, len(records), 10000):
+        response = session.post(url + '/picks/bulk', json=records[start:start + 10000])
+        if response.status_code != 200:
+            raise Exception('seeding failed with status {}'.format(response.status_code))
+    print("seeded %d robots, %d items and %d picks in %0.2fs" % (len(robots), len(items), len(records), time.time() - t0))
+
+
+def make_request(session, url, route, robots, items):
+    if route == 'pick':
+        return session.post(url + '/pick', params={'robot_name': random.choice(robots), 'item_name': random.choice(items)})
+    if route == 'question':
+        return session.post(url + '/question', data={'Human': random.choice(QUESTIONS)})
+    if route == 'feedback':
+        return session.post(url + '/feedback', data={'submit': 'question: ' + random.choice(QUESTIONS) + ' category: ' + random.choice(CATEGORIES)})
+    return session.get(url + '/')
+
+
+def run(url, mix, concurrency, duration, requests_total, robots, items):
+    """ Every client thread keeps one session and fires requests back to back until time or requests run out """
+    latencies = {route: [] for route in mix}
+    errors = {route: 0 for route in mix}
+    lock = threading.Lock()
+    routes = list(mix)
+    weights = [mix[route] for route in routes]
+    sent = [0]
+    deadline = time.time() + duration
+
+    def client():
+        session = requests.Session()
+        while time.time() < deadline:
+            with lock:
+                if requests_total and sent[0] >= requests_total:
+                    return
+                sent[0] += 1
+            route = random.choices(routes, weights)[0]
+            t0 = time.perf_counter()
+            try:
+                ok = make_request(session, url, route, robots, items).status_code == 200
+            except requests.exceptions.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - t0
+            with lock:
+                latencies[route].append(elapsed)
+                if not ok:
+                    errors[route] += 1
+
+    t0 = time.time()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(client)
+    wall = time.time() - t0
+
+    results = {'routes': {}, 'wall_seconds': wall}
+    everything = []
+    for route in routes:
+        values = sorted(latencies[route])
+        everything += values
+        results['routes'][route] = summarize(values, errors[route], wall)
+    results['total'] = summarize(sorted(everything), sum(errors.values()), wall)
+    return results
+
+
+def summarize(values, errors, wall):
+    return {
+        'requests': len(values),
+        'errors': errors,
+        'throughput': len(values) / wall if wall else 0.0,
+        'p50_ms': percentile(values, 50) * 1000 if values else None,
+        'p95_ms': percentile(values, 95) * 1000 if values else None,
+        'p99_ms': percentile(values, 99) * 1000 if values else None,
+        'max_ms': values[-1] * 1000 if values else None,
+    }
+
+
+def report(results):
+    print("%-10s %9s %7s %10s %9s %9s %9s" % ('route', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for route, r in list(results['routes'].items()) + [('total', results['total'])]:
+        if r['requests']:
+            print("%-10s %9d %7d %10.1f %9.2f %9.2f %9.2f" % (route, r['requests'], r['errors'], r['throughput'], r['p50_ms'], r['p95_ms'], r['p99_ms']))
+
+
+def compare(results, baseline, tolerance):
+    """ Returns the regressions of p95 latency, throughput and startup beyond tolerance against an earlier run """
+    regressions = []
+    for route, r in list(results['routes'].items()) + [('total', results['total'])]:
+        before = baseline['total'] if route == 'total' else baseline['routes'].get(route)
+        if not before or not before['requests'] or not r['requests']:
+            continue
+        if r['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append("%s p95 went from %0.2fms to %0.2fms" % (route, before['p95_ms'], r['p95_ms']))
+        if r['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append("%s throughput went from %0.1f to %0.1f req/s" % (route, before['throughput'], r['throughput']))
+
+    """ Startup is importing the app and ready adds loading the model, they are only compared when both runs started the app """
+    for key, name in (('startup_seconds', 'startup'), ('ready_seconds', 'ready')):
+        if results.get(key) and baseline.get(key):
+            if results[key] > baseline[key] * (1 + tolerance):
+                regressions.append("%s went from %0.2fs to %0.2fs" % (name, baseline[key], results[key]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test a local simtooreal app")
+    parser.add_argument('--url', default='http://localhost:8080', help="app to test, ignored with --start-app")
+    parser.add_argument('--start-app', action='store_true', help="start app.py locally with the current environment")
+    parser.add_argument('--port', type=int, default=8081, help="port for --start-app")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30, help="seconds to run for")
+    parser.add_argument('--requests', type=int, default=0, help="stop after this many requests, 0 means only --duration counts")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('pick=70,question=10,feedback=5,index=15'))
+    parser.add_argument('--robots', type=int, default=20)
+    parser.add_argument('--items', type=int, default=200)
+    parser.add_argument('--seed-picks', type=int, default=0, help="picks added through /picks/bulk before the run")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help="an earlier results file to check this run against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative regression for --compare")
+    parser.add_argument('--startup-runs', type=int, default=1, help="cold starts to take the median startup from with --start-app")
+    args = parser.parse_args()
+
+    app = None
+    url = args.url
+    startup = ready = None
+    if args.start_app:
+        if args.startup_runs > 1:
+            startup, ready = measure_startup(args.port, args.startup_runs)
+            print("median of %d cold starts: answered after %0.2fs, ready after %0.2fs" % (args.startup_runs, startup, ready))
+            app, url, _, _ = start_app(args.port)
+        else:
+            app, url, startup, ready = start_app(args.port)
+    try:
+        robots = ['bench-robot-%d' % i for i in range(args.robots)]
+        items = ['bench-item-%d' % i for i in range(args.items)]
+        seed(requests.Session(), url, robots, items, args.seed_picks)
+
+        results = run(url, args.mix, args.concurrency, args.duration, args.requests, robots, items)
+        results['config'] = {k: v for k, v in vars(args).items() if k not in ('compare', 'output')}
+        results['started_at'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        results['startup_seconds'] = startup
+        results['ready_seconds'] = ready
+
+        """ How long requests waited for a database connection tells pool problems apart from slow queries """
+        results['pool'] = requests.get(url + '/pool').json()
+        report(results)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("results written to " + args.output)
+    finally:
+        if app is not None:
+            app.terminate()
+            app.wait()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        sys.exit(1 if regressions else 0)
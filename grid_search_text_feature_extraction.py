@@ -67,12 +67,18 @@ import itertools
 
 #from sklearn.datasets import fetch_20newsgroups
 from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.feature_extraction.text import HashingVectorizer
 from sklearn.feature_extraction.text import TfidfTransformer
 from sklearn.linear_model import SGDClassifier
 from sklearn.model_selection import GridSearchCV
 from sklearn.pipeline import Pipeline
+from sklearn.base import clone
 from joblib import dump, load
-import pandas
+from training_corpus import TrainingCorpus, CachedTokenVectorizer
+import serving_model
+import tempfile
+import json
+import shutil
 import os
 
 print(__doc__)
@@ -82,28 +88,6 @@ logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(message)s')
 
 
-# #############################################################################
-# Load some categories from the training set
-df = pandas.read_csv('topics.csv')
-print(df)
-cats = df['question_topic'].values.tolist()
-print(list(dict.fromkeys(cats)))
-# categories = [
-#     'alt.atheism',
-#     'talk.religion.misc',
-# ]
-# Uncomment the following to do the analysis on all the categories
-categories = None
-
-print("Loading dataset for categories:")
-print(categories)
-
-# data = fetch_20newsgroups(subset='train', categories=categories)
-# print("%d documents" % len(data.filenames))
-# print("%d categories" % len(data.target_names))
-label_train = df['question_topic']
-text_train = df['question_text']
-
 # #############################################################################
 # Define a pipeline combining a text feature extractor with a simple
 # classifier
@@ -113,6 +97,14 @@ pipeline = Pipeline([
     ('clf', SGDClassifier()),
 ])
 
+# The search runs on the token ids of the training corpus, its vect step counts the same n-grams
+# as CountVectorizer would, only the winning parameters are fitted on the text again
+search_pipeline = Pipeline([
+    ('vect', CachedTokenVectorizer()),
+    ('tfidf', TfidfTransformer()),
+    ('clf', SGDClassifier()),
+])
+
 # uncommenting more parameters will give better exploring power but will
 # increase processing time in a combinatorial way
 parameters = {
@@ -127,87 +119,264 @@ parameters = {
     # 'clf__max_iter': (10, 50, 80),
 }
 
+# #############################################################################
+# Settings for the training loop, all of them can be overridden from the environment
+# With INCREMENTAL_TRAINING=True the loop wakes up every INCREMENTAL_INTERVAL seconds,
+# learns from the questions labeled since the last run and only reruns the full grid
+# search every FULL_RETRAIN_INTERVAL seconds or when accuracy on new questions drifts
+MODEL_PATH = os.environ.get('MODEL_PATH', 'clf.joblib')
+SERVING_MODEL_PATH = os.environ.get('SERVING_MODEL_PATH', 'clf.model')
+TRAINER_STATE_PATH = os.environ.get('TRAINER_STATE_PATH', 'trainer_state.json')
+INCREMENTAL_TRAINING = os.environ.get('INCREMENTAL_TRAINING', 'False') == 'True'
+INCREMENTAL_INTERVAL = int(os.environ.get('INCREMENTAL_INTERVAL', 300))
+FULL_RETRAIN_INTERVAL = int(os.environ.get('FULL_RETRAIN_INTERVAL', 86400))
+# Pushing clf.model to github is what deploys it, incrementally updated models are pushed at most every INCREMENTAL_PUSH_INTERVAL seconds
+# With MODEL_PUBLISH_PATH set, a file on a volume the app also mounts as its MODEL_PATH, every new model is copied there
+# instead and the app's watcher picks it up without a new image, github then only gets the full grid searches
+INCREMENTAL_PUSH_INTERVAL = int(os.environ.get('INCREMENTAL_PUSH_INTERVAL', 3600))
+MODEL_PUBLISH_PATH = os.environ.get('MODEL_PUBLISH_PATH')
+HASHING_FEATURES = int(os.environ.get('HASHING_FEATURES', 2 ** 18))
+DRIFT_WINDOW = int(os.environ.get('DRIFT_WINDOW', 200))
+DRIFT_TOLERANCE = float(os.environ.get('DRIFT_TOLERANCE', 0.05))
+
+# Settings for the model search
+# SEARCH_STRATEGY=grid scores every candidate on all the data, halving starts every candidate on a
+# slice of the questions and only gives the best 1/SEARCH_HALVING_FACTOR of them more data each round
+# SEARCH_CACHE_DIR keeps fitted vectorizers between runs, by default they only live for one search
+SEARCH_STRATEGY = os.environ.get('SEARCH_STRATEGY', 'grid')
+SEARCH_HALVING_FACTOR = int(os.environ.get('SEARCH_HALVING_FACTOR', 3))
+SEARCH_CACHE_DIR = os.environ.get('SEARCH_CACHE_DIR')
+SEARCH_REPORT_PATH = os.environ.get('SEARCH_REPORT_PATH', 'search_report.json')
+
+# Settings for the training corpus, topics.csv and every labeled question tokenized once and kept in CORPUS_DIR
+# Each cycle streams only the questions after the last one it has, CORPUS_ITERSIZE rows per round trip
+CORPUS_DIR = os.environ.get('CORPUS_DIR', 'corpus_cache')
+CORPUS_CSV_PATH = os.environ.get('CORPUS_CSV_PATH', 'topics.csv')
+CORPUS_ITERSIZE = int(os.environ.get('CORPUS_ITERSIZE', 10000))
+
+corpus = TrainingCorpus(CORPUS_DIR, CORPUS_CSV_PATH, pipeline.named_steps['vect'], CORPUS_ITERSIZE)
+
+sample_text = "Hi! If I sign up for your email list, can I select to get emails exclusively for sale products? I'm really only interested in shopping clearance deals."
+
+
+def connect():
+    """ These are the postgres environment variables to avoid storing sensitie info in the github repo """
+    POSTGRESQL_HOST = os.environ.get('POSTGRESQL_HOST')
+    POSTGRESQL_USER_NAME = os.environ.get('POSTGRESQL_USER_NAME')
+    POSTGRESQL_PASSWORD = os.environ.get('POSTGRESQL_PASSWORD')
+
+    """ We use psycopg2 to create a database connection either locally or in AWS """
+    conn = psycopg2.connect(host=POSTGRESQL_HOST, port = 5432, database="simtooreal", user=POSTGRESQL_USER_NAME, password=POSTGRESQL_PASSWORD)
+    conn.autocommit=True
+    return conn
+
+
+def save_model(clf):
+    # write to a temporary file and rename it so the app never reads a half written model
+    dump(clf, MODEL_PATH + '.tmp')
+    os.replace(MODEL_PATH + '.tmp', MODEL_PATH)
+    # the app serves the compact export, the pickle is kept because partial_fit needs the whole pipeline
+    serving_model.save(clf, SERVING_MODEL_PATH)
+
+
+def push_model(state):
+    """ A push to main builds a new image with the model in it and deploys it to ECS """
+    # Only the compact clf.model goes to github, the pickle is many times its size and only the trainer needs it
+    # The first push also stops tracking the pickle, .gitignore keeps it out after that
+    os.system("git rm --cached --quiet --ignore-unmatch " + MODEL_PATH)
+    os.system("git add " + SERVING_MODEL_PATH)
+    # We only commit when the model actually changed
+    if os.system("git diff --cached --quiet") != 0:
+        os.system("git commit -m 'updating pickle inference model'")
+        os.system("git push origin main")
+        os.system("git pull origin main --rebase")
+    state['last_push'] = time()
+
+
+def publish_model():
+    """ Copy the serving model next to the app, written under another name and renamed so it never reads half a model """
+    if MODEL_PUBLISH_PATH:
+        shutil.copyfile(SERVING_MODEL_PATH, MODEL_PUBLISH_PATH + '.tmp')
+        os.replace(MODEL_PUBLISH_PATH + '.tmp', MODEL_PUBLISH_PATH)
+
+
+def load_state():
+    """ The high water mark and drift window survive restarts of the trainer """
+    if os.path.exists(TRAINER_STATE_PATH):
+        with open(TRAINER_STATE_PATH) as f:
+            return json.load(f)
+    return {'high_water_mark': 0, 'last_full': 0, 'last_push': 0, 'best_score': None, 'recent': []}
+
+
+def save_state(state):
+    with open(TRAINER_STATE_PATH + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(TRAINER_STATE_PATH + '.tmp', TRAINER_STATE_PATH)
+
+
+def make_search(cache_dir):
+    """ The vect and tfidf steps are cached in cache_dir, candidates that only differ in clf__ parameters
+    reuse the fitted vectorizer of their fold instead of counting the n-grams again """
+    cached = Pipeline(search_pipeline.steps, memory=cache_dir)
+    if SEARCH_STRATEGY == 'halving':
+        from sklearn.experimental import enable_halving_search_cv
+        from sklearn.model_selection import HalvingGridSearchCV
+        return HalvingGridSearchCV(cached, parameters, factor=SEARCH_HALVING_FACTOR, refit=False, n_jobs=-1, verbose=1)
+    if SEARCH_STRATEGY != 'grid':
+        raise ValueError("SEARCH_STRATEGY must be grid or halving, not " + SEARCH_STRATEGY)
+    return GridSearchCV(cached, parameters, refit=False, n_jobs=-1, verbose=1)
+
+
+def report_search(search):
+    """ Fit time and score of every candidate, slowest first, so expensive parameters are easy to spot """
+    results = search.cv_results_
+    candidates = []
+    for i, params in enumerate(results['params']):
+        candidates.append({
+            'params': {name: list(value) if isinstance(value, tuple) else value for name, value in params.items()},
+            'mean_fit_time': float(results['mean_fit_time'][i]),
+            'mean_score_time': float(results['mean_score_time'][i]),
+            'mean_test_score': float(results['mean_test_score'][i]),
+            'rank_test_score': int(results['rank_test_score'][i]),
+            'n_resources': int(results['n_resources'][i]) if 'n_resources' in results else None,
+        })
+    candidates.sort(key=lambda candidate: -candidate['mean_fit_time'])
+    with open(SEARCH_REPORT_PATH + '.tmp', 'w') as f:
+        json.dump({'strategy': SEARCH_STRATEGY, 'best_score': search.best_score_, 'candidates': candidates}, f, indent=2)
+    os.replace(SEARCH_REPORT_PATH + '.tmp', SEARCH_REPORT_PATH)
+
+    print("fit time per candidate, slowest first:")
+    for candidate in candidates:
+        print("\t%0.3fs score %0.3f %r" % (candidate['mean_fit_time'], candidate['mean_test_score'], candidate['params']))
+    print("total fit time %0.3fs over %d candidates and %d folds, written to %s" % (sum(c['mean_fit_time'] for c in candidates) * search.n_splits_, len(candidates), search.n_splits_, SEARCH_REPORT_PATH))
+
+
+def make_online_model(best_parameters, text, labels):
+    """ The grid search winner's n-grams and regularization with a HashingVectorizer in front, it has
+    no vocabulary to refit so the classifier can keep learning from new questions with partial_fit """
+    online = Pipeline([
+        ('vect', HashingVectorizer(n_features=HASHING_FEATURES, ngram_range=best_parameters['vect__ngram_range'], alternate_sign=False, norm=None)),
+        ('tfidf', TfidfTransformer()),
+        ('clf', SGDClassifier(alpha=best_parameters['clf__alpha'], penalty=best_parameters['clf__penalty'], max_iter=best_parameters['clf__max_iter'])),
+    ])
+    return online.fit(text, labels)
+
+
+def full_retrain(cur, state):
+    """ if there is more data to collect from the database labeled by customers it will be collected and trained on """
+    corpus.update(cur.connection)
+    tokens = corpus.token_docs()
+    labels = corpus.labels()
+    print("training on %d questions, %d from the training file and %d from the database" % (len(labels), (corpus.data_ids() < 0).sum(), (corpus.data_ids() > 0).sum()))
+
+    # find the best parameters for both the feature extraction and the
+    # classifier
+    print("Performing " + SEARCH_STRATEGY + " search...")
+    print("pipeline:", [name for name, _ in search_pipeline.steps])
+    print("parameters:")
+    pprint(parameters)
+    t0 = time()
+    with tempfile.TemporaryDirectory(prefix='vectorizer_cache_') as cache_dir:
+        grid_search = make_search(SEARCH_CACHE_DIR or cache_dir)
+        grid_search.fit(tokens, labels)
+    report_search(grid_search)
+    best_parameters = grid_search.best_params_
+
+    """ The artifact has to turn text into features itself, so the winner is fitted once more with CountVectorizer """
+    texts = corpus.texts()
+    if INCREMENTAL_TRAINING:
+        clf = make_online_model(best_parameters, texts, labels)
+    else:
+        clf = clone(pipeline).set_params(**best_parameters).fit(texts, labels)
+    save_model(clf)
+    print("sample_text: " + sample_text)
+    print("prediction: " + clf.predict([sample_text])[0])
+    print("done in %0.3fs" % (time() - t0))
+    print()
+
+    print("Best score: %0.3f" % grid_search.best_score_)
+    print("Best parameters set:")
+    for param_name in sorted(parameters.keys()):
+        print("\t%s: %r" % (param_name, best_parameters[param_name]))
+
+    state['high_water_mark'] = corpus.meta['high_water_mark']
+    state['last_full'] = time()
+    state['best_score'] = grid_search.best_score_
+    state['recent'] = []
+
+    publish_model()
+    push_model(state)
+
+
+def incremental_update(cur, state):
+    """ Learn from the questions labeled since the last run, returns True when a full grid search is needed """
+    corpus.update(cur.connection)
+    start = corpus.start_after(state['high_water_mark'])
+    if start == corpus.meta['docs']:
+        print("no new labeled questions since data_id " + str(state['high_water_mark']))
+        return False
+
+    t0 = time()
+    clf = load(MODEL_PATH)
+    texts = corpus.texts(start)
+    labels = corpus.labels(start)
+
+    """ Every new question is scored before the model learns from it, that running accuracy is our drift signal """
+    predicted = clf.predict(texts)
+    state['recent'] = (state['recent'] + [int(p == l) for p, l in zip(predicted, labels)])[-DRIFT_WINDOW:]
+    accuracy = sum(state['recent']) / len(state['recent'])
+
+    """ partial_fit can not learn a category it has never seen, those wait for the next full grid search """
+    known = set(clf.classes_)
+    keep = [i for i, label in enumerate(labels) if label in known]
+    if keep:
+        features = clf[:-1].transform([texts[i] for i in keep])
+        clf.named_steps['clf'].partial_fit(features, [labels[i] for i in keep])
+        save_model(clf)
+        if MODEL_PUBLISH_PATH:
+            publish_model()
+        elif time() - state.get('last_push', 0) >= INCREMENTAL_PUSH_INTERVAL:
+            push_model(state)
+    state['high_water_mark'] = corpus.meta['high_water_mark']
+
+    print("learned from %d new questions in %0.3fs, accuracy on the last %d is %0.3f" % (len(keep), time() - t0, len(state['recent']), accuracy))
+    if len(keep) < len(labels):
+        print("found categories the model has never seen")
+        return True
+    return len(state['recent']) >= DRIFT_WINDOW and accuracy < state['best_score'] - DRIFT_TOLERANCE
+
+
+def can_update_incrementally(state):
+    """ The artifact has to be the hashing pipeline, the CountVectorizer pipeline written in full mode can not partial_fit """
+    if state['best_score'] is None or not os.path.exists(MODEL_PATH):
+        return False
+    clf = load(MODEL_PATH)
+    return isinstance(clf, Pipeline) and isinstance(clf.named_steps['vect'], HashingVectorizer)
+
+
 if __name__ == "__main__":
+    # multiprocessing requires the fork to happen in a __main__ protected
+    # block
+    state = load_state()
+    incremental_ready = INCREMENTAL_TRAINING and can_update_incrementally(state)
     while True:
-        # multiprocessing requires the fork to happen in a __main__ protected
-        # block
-
         # take newly labeled data out of database from customers
-        """ These are the postgres environment variables to avoid storing sensitie info in the github repo """
-        POSTGRESQL_HOST = os.environ.get('POSTGRESQL_HOST')
-        POSTGRESQL_USER_NAME = os.environ.get('POSTGRESQL_USER_NAME')
-        POSTGRESQL_PASSWORD = os.environ.get('POSTGRESQL_PASSWORD')
-        POSTGRESQL_HOST = os.environ.get('POSTGRESQL_HOST')
-
-        """ We use psycopg2 to create a database connection either locally or in AWS """
-        conn = psycopg2.connect(host=POSTGRESQL_HOST, port = 5432, database="simtooreal", user=POSTGRESQL_USER_NAME, password=POSTGRESQL_PASSWORD)
-        conn.autocommit=True
+        conn = connect()
 
         """ Create a cursor object """
         cur = conn.cursor()
 
-        """ A query that takes gives the question_text data """
-        cur.execute("SELECT question_text FROM public.questions;")
-        rows = cur.fetchall()
-        df1 = pandas.DataFrame(rows)
-        print("data from the database")
-        print(df1)
-        print("data from the training file")
-        print(text_train)
-
-        """ if there is more data to collect from the database labeled by customers it will be collected and trained on """
-        if rows != None:
-            text_combined = pandas.concat([text_train,df1], ignore_index=True,keys=['question_text'])
-
-        print("combined data")
-        print(text_combined)
-
-        """ A query that gives the question_topics """
-        cur.execute("SELECT question_topic FROM public.questions;")
-        rows = cur.fetchall()
-        df2 = pandas.DataFrame(rows)
-        print("labels from the database")
-        print(df2)
-        print("labels from the training file")
-        print(label_train)
-
-        """ if there is more data to collect from the database labeled by customers it will be collected and trained on """
-        if rows != None:
-            label_combined = pandas.concat([label_train,df2], ignore_index=True,keys=['question_topic'])
-
-        print("combined label")
-        print(label_combined)
-
-        # find the best parameters for both the feature extraction and the
-        # classifier
-        grid_search = GridSearchCV(pipeline, parameters, n_jobs=-1, verbose=1)
-
-        print("Performing grid search...")
-        print("pipeline:", [name for name, _ in pipeline.steps])
-        print("parameters:")
-        pprint(parameters)
-        t0 = time()
-        clf = grid_search.fit(text_combined, label_combined)
-        dump(clf, 'clf.joblib')
-        sample_text = "Hi! If I sign up for your email list, can I select to get emails exclusively for sale products? I'm really only interested in shopping clearance deals."
-        print("sample_text: " + sample_text)
-        print("prediction: " + clf.predict([sample_text])[0])
-        print("done in %0.3fs" % (time() - t0))
-        print()
-
-        print("Best score: %0.3f" % grid_search.best_score_)
-        print("Best parameters set:")
-        best_parameters = grid_search.best_estimator_.get_params()
-        for param_name in sorted(parameters.keys()):
-            print("\t%s: %r" % (param_name, best_parameters[param_name]))
-        
-        # We only change the pickle file when there is something to be changed
-        if os.system("git status | grep modified") == 0:
-            os.system("git add .")
-            os.system("git commit -m 'updating pickle inference model'")
-            os.system("git push origin main")
-            os.system("git pull origin main --rebase")
-
-        secs = 86400
+        if not incremental_ready or time() - state['last_full'] >= FULL_RETRAIN_INTERVAL:
+            full_retrain(cur, state)
+            incremental_ready = INCREMENTAL_TRAINING
+        elif incremental_update(cur, state):
+            print("running the full grid search early")
+            full_retrain(cur, state)
+        save_state(state)
+
+        cur.close()
+        conn.close()
+
+        secs = INCREMENTAL_INTERVAL if INCREMENTAL_TRAINING else FULL_RETRAIN_INTERVAL
         print("waiting " + str(secs) + " seconds before training again")
         sleep(secs)
@@ -1093,7 +1093,7 @@ resource "aws_lb_target_group" "simtooreal_backend" {
   health_check {
     interval = 60
     timeout  = 10
-    path     = "/"
+    path     = "/readyz"
     matcher  = "200"
   }
 
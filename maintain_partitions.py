@@ -0,0 +1,110 @@
+"""
+This is a maintenance loop for the partitioned picks table made by partition_picks.sql
+
+Once a day it makes sure the next PICKS_MONTHS_AHEAD monthly partitions exist and archives every
+partition whose last pick is older than PICKS_RETENTION_DAYS. Archiving copies the partition to a
+gzipped csv file in PICKS_ARCHIVE_DIR, then detaches and drops it, so old picks leave the database
+without a DELETE or the vacuuming that would follow it. The hourly rollups behind /stats are kept.
+
+Run it next to the trainer on the private instance with the same postgres environment variables
+python3 maintain_partitions.py
+"""
+from datetime import datetime, timedelta
+from time import time
+from time import sleep
+from psycopg2 import sql
+import psycopg2
+import gzip
+import os
+import re
+
+""" Maintenance settings, all of them can be overridden from the environment """
+PICKS_MONTHS_AHEAD = int(os.environ.get('PICKS_MONTHS_AHEAD', 3))
+PICKS_RETENTION_DAYS = int(os.environ.get('PICKS_RETENTION_DAYS', 365))
+PICKS_ARCHIVE_DIR = os.environ.get('PICKS_ARCHIVE_DIR', 'picks_archive')
+MAINTENANCE_INTERVAL = int(os.environ.get('MAINTENANCE_INTERVAL', 86400))
+
+""" The upper bound of a range partition, FOR VALUES FROM (...) TO ('2022-02-01 00:00:00') """
+UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+
+def connect():
+    """ These are the postgres environment variables to avoid storing sensitie info in the github repo """
+    POSTGRESQL_HOST = os.environ.get('POSTGRESQL_HOST')
+    POSTGRESQL_USER_NAME = os.environ.get('POSTGRESQL_USER_NAME')
+    POSTGRESQL_PASSWORD = os.environ.get('POSTGRESQL_PASSWORD')
+
+    """ We use psycopg2 to create a database connection either locally or in AWS """
+    return psycopg2.connect(host=POSTGRESQL_HOST, port = 5432, database="simtooreal", user=POSTGRESQL_USER_NAME, password=POSTGRESQL_PASSWORD)
+
+
+def expired_partitions(cur, cutoff):
+    """ Partitions whose whole range is before cutoff, oldest first, the default partition never expires """
+    cur.execute("SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'public.picks'::regclass;")
+    expired = []
+    for name, bound in cur.fetchall():
+        match = UPPER_BOUND.search(bound)
+        if match is None:
+            continue
+        upper = datetime.fromisoformat(match.group(1))
+        if upper <= cutoff:
+            expired.append((upper, name))
+    return [name for _, name in sorted(expired)]
+
+
+class LineCounter:
+    """ Counts the rows COPY writes so the archive can be checked before the partition is dropped """
+    def __init__(self, f):
+        self.f = f
+        self.lines = 0
+
+    def write(self, data):
+        self.lines += data.count(b'\n')
+        return self.f.write(data)
+
+
+def archive_partition(conn, name):
+    path = os.path.join(PICKS_ARCHIVE_DIR, name + '.csv.gz')
+    partition = sql.Identifier(name)
+    t0 = time()
+    with conn:
+        with conn.cursor() as cur:
+            """ Late picks with old timestamps must not slip in between the copy and the drop """
+            cur.execute(sql.SQL("LOCK TABLE public.{} IN SHARE MODE;").format(partition))
+            cur.execute(sql.SQL("SELECT count(*) FROM public.{};").format(partition))
+            rows = cur.fetchone()[0]
+
+            with gzip.open(path + '.tmp', 'wb') as f:
+                counter = LineCounter(f)
+                cur.copy_expert(sql.SQL("COPY public.{} TO STDOUT WITH (FORMAT csv, HEADER);").format(partition), counter)
+            if counter.lines - 1 != rows:
+                raise Exception(f"archive of {name} has {counter.lines - 1} rows but the partition has {rows}")
+            os.replace(path + '.tmp', path)
+
+            cur.execute(sql.SQL("ALTER TABLE public.picks DETACH PARTITION public.{};").format(partition))
+            cur.execute(sql.SQL("DROP TABLE public.{};").format(partition))
+    print("archived %d picks from %s to %s in %0.3fs" % (rows, name, path, time() - t0))
+
+
+def maintain(conn):
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT public.create_pick_partitions(%(months_ahead)s);", {'months_ahead': PICKS_MONTHS_AHEAD})
+            print("created " + str(cur.fetchone()[0]) + " new partitions")
+
+            cutoff = datetime.utcnow() - timedelta(days=PICKS_RETENTION_DAYS)
+            expired = expired_partitions(cur, cutoff)
+
+    os.makedirs(PICKS_ARCHIVE_DIR, exist_ok=True)
+    for name in expired:
+        archive_partition(conn, name)
+
+
+if __name__ == "__main__":
+    while True:
+        conn = connect()
+        maintain(conn)
+        conn.close()
+
+        print("waiting " + str(MAINTENANCE_INTERVAL) + " seconds before the next maintenance")
+        sleep(MAINTENANCE_INTERVAL)
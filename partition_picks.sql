@@ -0,0 +1,107 @@
+-- Turning public.picks into a table partitioned by month on pick_timestamp
+--
+-- The existing picks are not copied, the old table becomes one legacy partition holding everything
+-- up to the end of the month of the latest pick and new monthly partitions follow it, so the
+-- migration only costs the index builds. The legacy partition is archived as a whole by
+-- maintain_partitions.py once its last month falls out of the retention window.
+--
+-- psql -h database.simtooreal.com -U postgres -d simtooreal -f partition_picks.sql
+-- Running it again on a database that is already partitioned changes nothing
+
+\c simtooreal;
+
+BEGIN;
+
+-- create_pick_partitions() makes sure there is a partition for this month and the months_ahead after it
+-- maintain_partitions.py calls it every day, a month some other partition already covers is skipped
+CREATE OR REPLACE FUNCTION public.create_pick_partitions(months_ahead integer DEFAULT 3) RETURNS integer AS $$
+DECLARE
+	month date := date_trunc('month', now())::date;
+	created integer := 0;
+BEGIN
+	FOR i IN 0..months_ahead LOOP
+		IF to_regclass('public.picks_' || to_char(month, 'YYYY_MM')) IS NULL THEN
+			BEGIN
+				EXECUTE format('CREATE TABLE public.%I PARTITION OF public.picks FOR VALUES FROM (%L) TO (%L);',
+					'picks_' || to_char(month, 'YYYY_MM'), month, month + interval '1 month');
+				created := created + 1;
+			EXCEPTION
+				WHEN invalid_object_definition THEN
+					-- overlaps the legacy partition
+					NULL;
+				WHEN check_violation THEN
+					RAISE WARNING 'picks_default already holds picks from %, move them out before its partition can be created', month;
+			END;
+		END IF;
+		month := month + interval '1 month';
+	END LOOP;
+	RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+	legacy_end timestamp;
+BEGIN
+	IF EXISTS (SELECT FROM pg_partitioned_table WHERE partrelid = 'public.picks'::regclass) THEN
+		RAISE NOTICE 'public.picks is already partitioned';
+		RETURN;
+	END IF;
+
+	LOCK TABLE public.picks IN ACCESS EXCLUSIVE MODE;
+	SELECT date_trunc('month', greatest(max(pick_timestamp), now()::timestamp)) + interval '1 month' INTO legacy_end FROM public.picks;
+
+	-- The foreign key columns were declared serial, they are plain integers that must always be given
+	ALTER TABLE public.picks ALTER COLUMN item_id DROP DEFAULT, ALTER COLUMN robot_id DROP DEFAULT;
+	DROP SEQUENCE IF EXISTS public.picks_item_id_seq, public.picks_robot_id_seq;
+
+	-- Triggers with transition tables can not live on a partition, the parent gets it back below
+	DROP TRIGGER IF EXISTS count_new_picks ON public.picks;
+
+	-- The new key is (pick_id, pick_timestamp), the attach builds its index on the legacy rows
+	ALTER TABLE public.picks DROP CONSTRAINT picks_pkey;
+	ALTER TABLE public.picks RENAME TO picks_legacy;
+
+	CREATE TABLE public.picks (
+		pick_id integer NOT NULL DEFAULT nextval('public.picks_pick_id_seq'),
+		pick_timestamp TIMESTAMP NOT NULL,
+		item_id integer NOT NULL,
+		robot_id integer NOT NULL,
+		-- a key on a partitioned table has to contain the partition column, pick_id alone stays unique through its sequence
+		PRIMARY KEY (pick_id, pick_timestamp),
+	CONSTRAINT fk_item
+		FOREIGN KEY (item_id)
+			REFERENCES public.items(item_id),
+
+	CONSTRAINT fk_robot
+		FOREIGN KEY (robot_id)
+			REFERENCES public.robots(robot_id)
+	) PARTITION BY RANGE (pick_timestamp);
+	ALTER SEQUENCE public.picks_pick_id_seq OWNED BY public.picks.pick_id;
+
+	-- Covering indexes for picks of a robot or of an item over time, and for time ranges alone
+	CREATE INDEX picks_robot_time ON public.picks (robot_id, pick_timestamp) INCLUDE (item_id);
+	CREATE INDEX picks_item_time ON public.picks (item_id, pick_timestamp) INCLUDE (robot_id);
+	CREATE INDEX picks_time ON public.picks (pick_timestamp);
+
+	-- A validated check constraint lets the attach skip its own scan of the legacy rows
+	ALTER TABLE public.picks_legacy ALTER COLUMN item_id SET NOT NULL, ALTER COLUMN robot_id SET NOT NULL;
+	EXECUTE format('ALTER TABLE public.picks_legacy ADD CONSTRAINT picks_legacy_range CHECK (pick_timestamp < %L);', legacy_end);
+	EXECUTE format('ALTER TABLE public.picks ATTACH PARTITION public.picks_legacy FOR VALUES FROM (MINVALUE) TO (%L);', legacy_end);
+	ALTER TABLE public.picks_legacy DROP CONSTRAINT picks_legacy_range;
+
+	-- Picks whose month has no partition, like a bulk upload of very old picks, land here instead of failing
+	CREATE TABLE public.picks_default PARTITION OF public.picks DEFAULT;
+
+	-- Put the rollup trigger from schema.sql back on the partitioned table
+	IF EXISTS (SELECT FROM pg_proc WHERE proname = 'count_new_picks') THEN
+		CREATE TRIGGER count_new_picks AFTER INSERT ON public.picks
+			REFERENCING NEW TABLE AS new_picks
+			FOR EACH STATEMENT EXECUTE FUNCTION public.count_new_picks();
+	END IF;
+END;
+$$;
+
+SELECT public.create_pick_partitions(3);
+
+COMMIT;
@@ -36,4 +36,56 @@ CONSTRAINT fk_item
 CONSTRAINT fk_robot
 	  FOREIGN KEY (robot_id)
 	      REFERENCES public.robots(robot_id)
-	);
\ No newline at end of file
+	);
+
+-- Hourly pick counts per robot and per item, /stats reads these instead of scanning picks
+-- A statement level trigger keeps them up to date for every insert into picks, one row per
+-- robot or item and hour touched by the statement, so a bulk insert costs one upsert per group
+-- Running this file again on an existing database adds the rollups and backfills them once
+BEGIN;
+LOCK TABLE public.picks IN SHARE MODE;
+
+	CREATE TABLE IF NOT EXISTS public.pick_counts_robot_hour (
+		robot_id INTEGER NOT NULL REFERENCES public.robots(robot_id),
+		bucket TIMESTAMP NOT NULL,
+		picks BIGINT NOT NULL,
+		PRIMARY KEY (robot_id, bucket)
+	);
+	CREATE INDEX IF NOT EXISTS pick_counts_robot_hour_bucket ON public.pick_counts_robot_hour (bucket);
+
+	CREATE TABLE IF NOT EXISTS public.pick_counts_item_hour (
+		item_id INTEGER NOT NULL REFERENCES public.items(item_id),
+		bucket TIMESTAMP NOT NULL,
+		picks BIGINT NOT NULL,
+		PRIMARY KEY (item_id, bucket)
+	);
+	CREATE INDEX IF NOT EXISTS pick_counts_item_hour_bucket ON public.pick_counts_item_hour (bucket);
+
+CREATE OR REPLACE FUNCTION public.count_new_picks() RETURNS trigger AS $$
+BEGIN
+	-- ORDER BY keeps the row locks in the same order for concurrent statements so they can not deadlock
+	INSERT INTO public.pick_counts_robot_hour (robot_id, bucket, picks)
+		SELECT robot_id, date_trunc('hour', pick_timestamp), count(*) FROM new_picks GROUP BY 1, 2 ORDER BY 1, 2
+	ON CONFLICT (robot_id, bucket) DO UPDATE SET picks = public.pick_counts_robot_hour.picks + EXCLUDED.picks;
+
+	INSERT INTO public.pick_counts_item_hour (item_id, bucket, picks)
+		SELECT item_id, date_trunc('hour', pick_timestamp), count(*) FROM new_picks GROUP BY 1, 2 ORDER BY 1, 2
+	ON CONFLICT (item_id, bucket) DO UPDATE SET picks = public.pick_counts_item_hour.picks + EXCLUDED.picks;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS count_new_picks ON public.picks;
+CREATE TRIGGER count_new_picks AFTER INSERT ON public.picks
+	REFERENCING NEW TABLE AS new_picks
+	FOR EACH STATEMENT EXECUTE FUNCTION public.count_new_picks();
+
+INSERT INTO public.pick_counts_robot_hour (robot_id, bucket, picks)
+	SELECT robot_id, date_trunc('hour', pick_timestamp), count(*) FROM public.picks
+	WHERE NOT EXISTS (SELECT FROM public.pick_counts_robot_hour) GROUP BY 1, 2;
+
+INSERT INTO public.pick_counts_item_hour (item_id, bucket, picks)
+	SELECT item_id, date_trunc('hour', pick_timestamp), count(*) FROM public.picks
+	WHERE NOT EXISTS (SELECT FROM public.pick_counts_item_hour) GROUP BY 1, 2;
+
+COMMIT;
@@ -0,0 +1,191 @@
+"""
+This is the compact model format the app serves from, written by grid_search_text_feature_extraction.py
+
+A fitted vect -> tfidf -> linear classifier pipeline is reduced to what scoring needs: the vectorizer
+settings, the sorted vocabulary, the idf weights and the float32 coefficients, sparse when that is
+smaller. Everything lives in one file, a short JSON header followed by raw arrays that are memory
+mapped on load, so opening it costs no unpickling and every worker process on a host shares the
+same pages through the OS page cache. A new model replaces the file with os.replace, a process still
+scoring with the old one keeps its mapping of the old file until it lets go of it.
+
+save(clf, 'clf.model')
+with open('clf.model', 'rb') as f:
+    clf = load(f)
+clf.predict(['Where is my order?'])
+"""
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+import scipy.sparse
+import numpy
+import json
+import os
+
+MAGIC = b'SIMTOOREAL-MODEL\n'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+""" Vectorizer settings that decide how a text turns into terms, everything else only matters when fitting """
+TEXT_PARAMS = ('input', 'encoding', 'decode_error', 'strip_accents', 'lowercase', 'token_pattern', 'ngram_range', 'analyzer', 'binary')
+HASHING_PARAMS = TEXT_PARAMS + ('n_features', 'alternate_sign', 'norm')
+
+
+def is_serving_model(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _vectorizer_header(vect):
+    params = vect.get_params()
+    if params.get('preprocessor') is not None or params.get('tokenizer') is not None or callable(params['analyzer']):
+        raise ValueError("a vectorizer with a custom preprocessor, tokenizer or analyzer can not be exported")
+    if isinstance(vect, HashingVectorizer):
+        header = {'kind': 'hashing', 'params': {name: params[name] for name in HASHING_PARAMS}}
+    elif isinstance(vect, CountVectorizer):
+        header = {'kind': 'count', 'params': {name: params[name] for name in TEXT_PARAMS}}
+    else:
+        raise ValueError("can not export a " + type(vect).__name__)
+    stop_words = vect.get_stop_words()
+    header['params']['stop_words'] = sorted(stop_words) if stop_words else None
+    header['params']['ngram_range'] = list(header['params']['ngram_range'])
+    return header
+
+
+def save(clf, path):
+    """ Writes the vect, tfidf and clf steps of a pipeline, or of the best estimator of a search, to path """
+    pipeline = getattr(clf, 'best_estimator_', clf)
+    vect, tfidf, linear = pipeline.named_steps['vect'], pipeline.named_steps['tfidf'], pipeline.named_steps['clf']
+
+    arrays = {}
+    header = {'format': FORMAT_VERSION, 'vectorizer': _vectorizer_header(vect), 'classes': linear.classes_.tolist(),
+        'tfidf': {'norm': tfidf.norm, 'use_idf': tfidf.use_idf, 'sublinear_tf': tfidf.sublinear_tf}}
+
+    if header['vectorizer']['kind'] == 'count':
+        """ CountVectorizer numbers its features in sorted order, so a term's position in the sorted array is its column """
+        terms = sorted(vect.vocabulary_, key=vect.vocabulary_.get)
+        arrays['terms'] = numpy.array([term.encode('utf-8') for term in terms])
+        if list(numpy.argsort(arrays['terms'], kind='stable')) != list(range(len(terms))):
+            raise ValueError("the vocabulary is not numbered in sorted order")
+    if tfidf.use_idf:
+        arrays['idf'] = tfidf.idf_.astype(numpy.float32)
+
+    """ A CSR matrix costs 8 bytes per nonzero against 4 per coefficient when dense """
+    coef = linear.coef_.astype(numpy.float32)
+    if numpy.count_nonzero(coef) * 2 < coef.size:
+        sparse = scipy.sparse.csr_matrix(coef)
+        arrays['coef_data'] = sparse.data
+        arrays['coef_indices'] = sparse.indices.astype(numpy.int32)
+        arrays['coef_indptr'] = sparse.indptr.astype(numpy.int32)
+        header['coef_shape'] = list(coef.shape)
+    else:
+        arrays['coef'] = numpy.ascontiguousarray(coef)
+    arrays['intercept'] = numpy.asarray(linear.intercept_, dtype=numpy.float32)
+
+    """ Array offsets are counted from the end of the header, so the header can be laid out before them """
+    offset = 0
+    header['arrays'] = {}
+    for name, array in arrays.items():
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header_bytes = json.dumps(header).encode('utf-8')
+    start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    with open(path + '.tmp', 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(start + header['arrays'][name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(start + offset)
+    os.replace(path + '.tmp', path)
+
+
+class ServingModel:
+    """ Scores texts the way the exported pipeline did, with the same predict, decision_function and classes_ """
+    def __init__(self, header, arrays):
+        self.header = header
+        self.classes_ = numpy.array(header['classes'])
+        vectorizer = header['vectorizer']
+        params = dict(vectorizer['params'], ngram_range=tuple(vectorizer['params']['ngram_range']))
+        if vectorizer['kind'] == 'hashing':
+            self._hashing = HashingVectorizer(**params)
+        else:
+            self._hashing = None
+            self._binary = params.pop('binary')
+            self._analyzer = CountVectorizer(**params).build_analyzer()
+            self._terms = arrays['terms']
+        self._idf = arrays.get('idf')
+        if 'coef' in arrays:
+            self._coef_t = arrays['coef'].T
+        else:
+            self._coef_t = scipy.sparse.csr_matrix((arrays['coef_data'], arrays['coef_indices'], arrays['coef_indptr']), shape=header['coef_shape']).T.tocsr()
+        self._intercept = arrays['intercept']
+
+    def _counts(self, texts):
+        """ Every term of every text is looked up in the sorted vocabulary at once, terms it does not have are dropped """
+        rows, tokens = [], []
+        for i, text in enumerate(texts):
+            for token in self._analyzer(text):
+                rows.append(i)
+                tokens.append(token.encode('utf-8'))
+        if tokens:
+            tokens = numpy.array(tokens)
+            columns = numpy.minimum(numpy.searchsorted(self._terms, tokens), len(self._terms) - 1)
+            found = self._terms[columns] == tokens
+            rows, columns = numpy.array(rows)[found], columns[found]
+        else:
+            columns = []
+        counts = scipy.sparse.csr_matrix((numpy.ones(len(rows)), (rows, columns)), shape=(len(texts), len(self._terms)))
+        counts.sum_duplicates()
+        if self._binary:
+            counts.data[:] = 1
+        return counts
+
+    def transform(self, texts):
+        features = self._hashing.transform(texts) if self._hashing is not None else self._counts(texts)
+        tfidf = self.header['tfidf']
+        if tfidf['sublinear_tf']:
+            numpy.log(features.data, features.data)
+            features.data += 1
+        if self._idf is not None:
+            """ Scaling the stored values in place reads only the idf weights of terms that occur """
+            features = features.tocsr()
+            features.data *= self._idf[features.indices]
+        if tfidf['norm']:
+            features = normalize(features, norm=tfidf['norm'], copy=False)
+        return features
+
+    def decision_function(self, texts):
+        scores = self.transform(texts) @ self._coef_t
+        if scipy.sparse.issparse(scores):
+            scores = scores.toarray()
+        scores = numpy.asarray(scores) + self._intercept
+        return scores.ravel() if scores.shape[1] == 1 else scores
+
+    def predict(self, texts):
+        scores = self.decision_function(texts)
+        if scores.ndim == 1:
+            return self.classes_[(scores > 0).astype(int)]
+        return self.classes_[scores.argmax(axis=1)]
+
+
+def load(f):
+    """ Maps an open model file, the arrays are read from the page cache as they are used """
+    f.seek(0)
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("not a serving model file")
+    header_length = int.from_bytes(f.read(8), 'little')
+    header = json.loads(f.read(header_length))
+    if header['format'] != FORMAT_VERSION:
+        raise ValueError("serving model format " + str(header['format']) + " is not supported")
+    start = -(-(len(MAGIC) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+
+    data = numpy.memmap(f, dtype=numpy.uint8, mode='r')
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = numpy.dtype(spec['dtype'])
+        count = int(numpy.prod(spec['shape']))
+        begin = start + spec['offset']
+        arrays[name] = data[begin:begin + count * dtype.itemsize].view(dtype).reshape(spec['shape'])
+    return ServingModel(header, arrays)
@@ -0,0 +1,82 @@
+"""
+Checks that ConnectionPool reuses its connections instead of reconnecting, run with python3 -m pytest test_connection_pool.py
+Like test_training_corpus.py it needs no running app or database, postgres is replaced by a fake connect
+"""
+import os
+os.environ.setdefault('WARMUP', 'False')
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import psycopg2
+import psycopg2.extensions
+from app import ConnectionPool
+import app
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.autocommit = False
+        self.info = self
+
+    @property
+    def transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, vars=None):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeConnect:
+    """ Counts the connections opened and the keyword arguments they were opened with """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.kwargs = None
+
+    def __call__(self, *args, **kwargs):
+        with self._lock:
+            self.opened += 1
+            self.kwargs = kwargs
+        return FakeConnection()
+
+
+def test_concurrent_checkouts_reuse_connections(monkeypatch):
+    connect = FakeConnect()
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+    pool = ConnectionPool(1, 8, timeout=5, ping_after=3600)
+    together = threading.Barrier(8)
+
+    def client(_):
+        for _ in range(50):
+            conn = pool.getconn()
+            """ Every client holds a connection at the same time, as the dashboard readers of one page do """
+            together.wait()
+            pool.putconn(conn)
+            together.wait()
+
+    with ThreadPoolExecutor(8) as clients:
+        list(clients.map(client, range(8)))
+    """ 400 checkouts, never more connections than the pool may hold at once """
+    assert pool.stats()['checkouts'] == 400
+    assert connect.opened <= 8
+
+
+def test_connect_is_bounded(monkeypatch):
+    """ Without a connect timeout a blackholed host holds a checkout for the OS TCP timeout """
+    connect = FakeConnect()
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+    pool = ConnectionPool(1, 2, timeout=5, ping_after=3600, **app.db_pool.connect_kwargs)
+    pool.putconn(pool.getconn())
+    assert connect.kwargs['connect_timeout'] == app.POSTGRESQL_CONNECT_TIMEOUT
@@ -0,0 +1,66 @@
+"""
+Checks that CachedTokenVectorizer counts what CountVectorizer counts, run with python3 -m pytest test_training_corpus.py
+Unlike test.py it needs no running app or database
+"""
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.feature_extraction.text import TfidfTransformer
+from sklearn.linear_model import SGDClassifier
+from sklearn.model_selection import cross_val_score
+from sklearn.pipeline import Pipeline
+from training_corpus import CachedTokenVectorizer
+import scipy.sparse
+import numpy
+
+TEXTS = [
+    "where is my order", "my order is late", "do you price match", "is this in stock near me",
+    "can I return a jacket", "order a jacket in stock", "where is the store near me", "late order refund",
+]
+
+
+def token_docs(texts):
+    """ Token ids the way TrainingCorpus numbers them, in order of first appearance """
+    tokenize = CountVectorizer().build_analyzer()
+    vocabulary = {}
+    docs = numpy.empty(len(texts), dtype=object)
+    for i, text in enumerate(texts):
+        docs[i] = numpy.array([vocabulary.setdefault(token, len(vocabulary)) for token in tokenize(text)], dtype=numpy.int32)
+    return docs
+
+
+def same_columns(a, b):
+    """ The two vectorizers number their columns differently, sorting the columns makes them comparable """
+    a, b = a.toarray(), b.toarray()
+    return a.shape == b.shape and (a[:, numpy.lexsort(a[::-1])] == b[:, numpy.lexsort(b[::-1])]).all()
+
+
+def test_transform_matches_fit_transform():
+    docs = token_docs(TEXTS)
+    for ngram_range in ((1, 1), (1, 2), (2, 2), (1, 3)):
+        vect = CachedTokenVectorizer(ngram_range=ngram_range).fit(docs)
+        assert (vect.transform(docs) != vect.fit_transform(docs)).nnz == 0
+        """ A few of the documents, without the highest token id, still get the columns fit gave them """
+        assert (vect.transform(docs[:2]) != vect.fit_transform(docs)[:2]).nnz == 0
+
+
+def test_held_out_split_matches_count_vectorizer():
+    docs = token_docs(TEXTS)
+    for ngram_range in ((1, 1), (1, 2)):
+        for max_df in (0.5, 1.0, 2):
+            vect = CachedTokenVectorizer(ngram_range=ngram_range, max_df=max_df)
+            count = CountVectorizer(ngram_range=ngram_range, max_df=max_df)
+            ours = scipy.sparse.vstack([vect.fit_transform(docs[:5]), vect.transform(docs[5:])])
+            theirs = scipy.sparse.vstack([count.fit_transform(TEXTS[:5]), count.transform(TEXTS[5:])])
+            assert same_columns(ours, theirs)
+
+
+def test_word_order_survives_cross_validation():
+    """ Only the bigram tells these labels apart, every test fold has to be scored with the bigrams fit found
+    even the folds that lack the word with the highest token id """
+    texts = ["alpha beta", "beta alpha"] * 19 + ["alpha beta omega", "beta alpha omega"]
+    labels = ["first", "second"] * 20
+
+    def score(vect, X):
+        pipeline = Pipeline([('vect', vect), ('tfidf', TfidfTransformer()), ('clf', SGDClassifier(random_state=0))])
+        return cross_val_score(pipeline, X, labels, cv=5).mean()
+
+    assert score(CachedTokenVectorizer(ngram_range=(1, 2)), token_docs(texts)) == score(CountVectorizer(ngram_range=(1, 2)), texts) == 1.0
@@ -0,0 +1,266 @@
+"""
+This is the training data stage of grid_search_text_feature_extraction.py
+
+The labeled questions of topics.csv and of the questions table are kept on disk in CORPUS_DIR as flat
+columns: data ids, label codes, the utf-8 text and the text already split into tokens by the same
+preprocessing and token pattern as CountVectorizer, with every token stored as an integer id. A training
+cycle streams only the questions after the highest data_id it has from a server side cursor, tokenizes
+them once and appends them. Everything else is memory mapped from the files, nothing is parsed again.
+
+meta.json is written last and records how long every column is, bytes appended by an update that did not
+finish are cut off by the next one. A changed topics.csv or tokenizer rebuilds the corpus from scratch.
+
+corpus = TrainingCorpus('corpus_cache', 'topics.csv')
+corpus.update(conn)
+ids, texts, labels, tokens = corpus.data_ids(), corpus.texts(), corpus.labels(), corpus.token_docs()
+"""
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.feature_extraction.text import CountVectorizer
+from time import time
+import scipy.sparse
+import numbers
+import pandas
+import numpy
+import shutil
+import json
+import os
+
+FORMAT_VERSION = 1
+
+""" Every column file, its dtype and the meta.json count its length is kept in """
+COLUMNS = {
+    'data_ids': ('<i8', 'docs'),
+    'label_codes': ('<i4', 'docs'),
+    'text_offsets': ('<i8', 'docs_plus_one'),
+    'text': ('u1', 'text_bytes'),
+    'token_offsets': ('<i8', 'docs_plus_one'),
+    'tokens': ('<i4', 'tokens'),
+}
+
+
+class TrainingCorpus:
+    def __init__(self, path, csv_path, vectorizer=None, itersize=10000):
+        self.path = path
+        self.csv_path = csv_path
+        self.itersize = itersize
+        vectorizer = vectorizer if vectorizer is not None else CountVectorizer()
+        self._preprocess = vectorizer.build_preprocessor()
+        self._tokenize = vectorizer.build_tokenizer()
+        self.tokenizer = {'lowercase': vectorizer.lowercase, 'strip_accents': vectorizer.strip_accents, 'token_pattern': vectorizer.token_pattern}
+        self.meta = None
+        self._vocabulary = None
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _signature(self):
+        """ The csv rows come first in the corpus, a different csv or tokenizer means starting over """
+        st = os.stat(self.csv_path)
+        return {'format': FORMAT_VERSION, 'csv': [os.path.abspath(self.csv_path), st.st_size, st.st_mtime], 'tokenizer': self.tokenizer}
+
+    def _lengths(self, meta):
+        return {'docs': meta['docs'], 'docs_plus_one': meta['docs'] + 1, 'text_bytes': meta['text_bytes'], 'tokens': meta['tokens']}
+
+    def _open(self):
+        """ Reads meta.json and cuts every column back to the length it records """
+        signature = self._signature()
+        try:
+            with open(self._file('meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = None
+        if meta is None or meta['signature'] != signature:
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path)
+            meta = {'signature': signature, 'docs': 0, 'text_bytes': 0, 'tokens': 0, 'high_water_mark': 0, 'labels': [], 'vocabulary_size': 0}
+            for name in COLUMNS:
+                open(self._file(name), 'wb').close()
+            open(self._file('vocabulary.txt'), 'wb').close()
+            self._vocabulary = {}
+            numpy.zeros(1, dtype='<i8').tofile(self._file('text_offsets'))
+            numpy.zeros(1, dtype='<i8').tofile(self._file('token_offsets'))
+            self.meta = meta
+            self._append(self._read_csv())
+            return
+
+        lengths = self._lengths(meta)
+        for name, (dtype, length) in COLUMNS.items():
+            with open(self._file(name), 'r+b') as f:
+                f.truncate(lengths[length] * numpy.dtype(dtype).itemsize)
+        with open(self._file('vocabulary.txt'), encoding='utf-8') as f:
+            terms = f.read().split('\n')[:meta['vocabulary_size']]
+        with open(self._file('vocabulary.txt'), 'w', encoding='utf-8') as f:
+            f.write(''.join(term + '\n' for term in terms))
+        self._vocabulary = {term: i for i, term in enumerate(terms)}
+        self.meta = meta
+
+    def _read_csv(self):
+        """ The csv questions have no data_id, they get negative ones so the database rows always sort after them """
+        df = pandas.read_csv(self.csv_path)
+        return [(i - len(df), text, topic) for i, (text, topic) in enumerate(zip(df['question_text'], df['question_topic']))]
+
+    def _append(self, rows):
+        """ Appends (data_id, text, topic) rows to every column and then commits them in meta.json """
+        if self._vocabulary is None:
+            self._vocabulary = {}
+        meta = dict(self.meta, labels=list(self.meta['labels']))
+        label_codes = {label: i for i, label in enumerate(meta['labels'])}
+        new_terms = []
+        data_ids, codes, text_offsets, token_offsets, text, tokens = [], [], [], [], [], []
+        for data_id, question_text, topic in rows:
+            if topic not in label_codes:
+                label_codes[topic] = len(meta['labels'])
+                meta['labels'].append(topic)
+            encoded = str(question_text).encode('utf-8')
+            doc_tokens = []
+            for token in self._tokenize(self._preprocess(str(question_text))):
+                token_id = self._vocabulary.get(token)
+                if token_id is None:
+                    token_id = self._vocabulary[token] = len(self._vocabulary)
+                    new_terms.append(token)
+                doc_tokens.append(token_id)
+            data_ids.append(data_id)
+            codes.append(label_codes[topic])
+            text.append(encoded)
+            meta['text_bytes'] += len(encoded)
+            text_offsets.append(meta['text_bytes'])
+            tokens += doc_tokens
+            meta['tokens'] += len(doc_tokens)
+            token_offsets.append(meta['tokens'])
+            meta['high_water_mark'] = max(meta['high_water_mark'], data_id)
+        if not data_ids:
+            return 0
+
+        for name, values in (('data_ids', data_ids), ('label_codes', codes), ('text_offsets', text_offsets), ('token_offsets', token_offsets), ('tokens', tokens)):
+            with open(self._file(name), 'ab') as f:
+                numpy.asarray(values, dtype=COLUMNS[name][0]).tofile(f)
+        with open(self._file('text'), 'ab') as f:
+            f.write(b''.join(text))
+        with open(self._file('vocabulary.txt'), 'a', encoding='utf-8') as f:
+            f.write(''.join(term + '\n' for term in new_terms))
+        for name in list(COLUMNS) + ['vocabulary.txt']:
+            with open(self._file(name), 'rb') as f:
+                os.fsync(f.fileno())
+
+        meta['docs'] += len(data_ids)
+        meta['vocabulary_size'] = len(self._vocabulary)
+        with open(self._file('meta.json.tmp'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(self._file('meta.json.tmp'), self._file('meta.json'))
+        self.meta = meta
+        return len(data_ids)
+
+    def update(self, conn):
+        """ Streams the questions labeled since the last update and appends them, returns how many there were """
+        t0 = time()
+        self._open()
+        added = 0
+        autocommit = conn.autocommit
+        conn.autocommit = False
+        try:
+            with conn.cursor(name='training_corpus') as cur:
+                cur.itersize = self.itersize
+                cur.execute("SELECT data_id, question_text, question_topic FROM public.questions WHERE data_id > %(after)s ORDER BY data_id;", {'after': self.meta['high_water_mark']})
+                while True:
+                    rows = cur.fetchmany(self.itersize)
+                    if not rows:
+                        break
+                    added += self._append(rows)
+        finally:
+            conn.rollback()
+            conn.autocommit = autocommit
+        print("corpus has %d questions and %d tokens, %d new in %0.3fs" % (self.meta['docs'], self.meta['tokens'], added, time() - t0))
+        return added
+
+    def _column(self, name):
+        dtype, length = COLUMNS[name]
+        count = self._lengths(self.meta)[length]
+        if count == 0:
+            return numpy.empty(0, dtype=dtype)
+        return numpy.memmap(self._file(name), dtype=dtype, mode='r', shape=(count,))
+
+    def data_ids(self):
+        return self._column('data_ids')
+
+    def labels(self, start=0):
+        return numpy.array(self.meta['labels'], dtype=object)[self._column('label_codes')[start:]]
+
+    def texts(self, start=0):
+        text = self._column('text')
+        offsets = self._column('text_offsets')
+        return [bytes(text[offsets[i]:offsets[i + 1]]).decode('utf-8') for i in range(start, self.meta['docs'])]
+
+    def token_docs(self, start=0):
+        """ One array of token ids per question, views into the memory mapped tokens column """
+        tokens = self._column('tokens')
+        offsets = self._column('token_offsets')
+        docs = numpy.empty(self.meta['docs'] - start, dtype=object)
+        for i in range(start, self.meta['docs']):
+            docs[i - start] = tokens[offsets[i]:offsets[i + 1]]
+        return docs
+
+    def start_after(self, data_id):
+        """ The position of the first question with a data_id greater than data_id """
+        return int(numpy.searchsorted(self.data_ids(), data_id, side='right'))
+
+
+class CachedTokenVectorizer(BaseEstimator, TransformerMixin):
+    """ CountVectorizer's n-gram counting and max_df pruning on token id arrays from a TrainingCorpus,
+    it sees exactly the n-grams CountVectorizer would find in the text, just without tokenizing it again """
+    def __init__(self, ngram_range=(1, 1), max_df=1.0, min_df=1):
+        self.ngram_range = ngram_range
+        self.max_df = max_df
+        self.min_df = min_df
+
+    def _ngram_keys(self, docs, base):
+        """ Each n-gram of token ids becomes one integer key, returned with the index of its document
+        The key is the n-gram written in digits of base, token ids fit only below base - 1 so fit picks the base
+        and transform reuses it, an n-gram with a token fit never saw can not have a column and is left out """
+        lengths = numpy.fromiter((len(doc) for doc in docs), dtype=numpy.int64, count=len(docs))
+        tokens = numpy.concatenate([numpy.asarray(doc, dtype=numpy.int64) for doc in docs]) if len(docs) else numpy.empty(0, dtype=numpy.int64)
+        owners = numpy.repeat(numpy.arange(len(docs)), lengths)
+        known = tokens < base - 1
+        keys, rows = [], []
+        low, high = self.ngram_range
+        for n in range(low, high + 1):
+            if len(tokens) < n:
+                continue
+            count = len(tokens) - n + 1
+            key = numpy.zeros(count, dtype=object if base ** n >= 2 ** 62 else numpy.int64)
+            valid = numpy.ones(count, dtype=bool)
+            for j in range(n):
+                key = key * base + numpy.where(known[j:count + j], tokens[j:count + j] + 1, 0)
+                valid &= known[j:count + j] & (owners[j:count + j] == owners[:count])
+            keys.append(key[valid] * (high + 1) + n)
+            rows.append(owners[:count][valid])
+        if not keys:
+            return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.int64)
+        return numpy.concatenate(keys), numpy.concatenate(rows)
+
+    def fit(self, docs, y=None):
+        self.fit_transform(docs)
+        return self
+
+    def fit_transform(self, docs, y=None):
+        self.base_ = max((int(numpy.max(doc)) for doc in docs if len(doc)), default=0) + 2
+        keys, rows = self._ngram_keys(docs, self.base_)
+        unique_keys, columns = numpy.unique(keys, return_inverse=True)
+        counts = scipy.sparse.csr_matrix((numpy.ones(len(keys), dtype=numpy.int64), (rows, columns.ravel())), shape=(len(docs), len(unique_keys)))
+        counts.sum_duplicates()
+
+        document_frequency = numpy.bincount(counts.indices, minlength=len(unique_keys))
+        max_count = self.max_df if isinstance(self.max_df, numbers.Integral) else self.max_df * len(docs)
+        min_count = self.min_df if isinstance(self.min_df, numbers.Integral) else self.min_df * len(docs)
+        keep = (document_frequency <= max_count) & (document_frequency >= min_count)
+        if not keep.any():
+            raise ValueError("After pruning, no terms remain. Try a lower min_df or a higher max_df.")
+        self.keys_ = unique_keys[keep]
+        return counts[:, numpy.flatnonzero(keep)]
+
+    def transform(self, docs):
+        keys, rows = self._ngram_keys(docs, self.base_)
+        columns = numpy.minimum(numpy.searchsorted(self.keys_, keys), len(self.keys_) - 1)
+        found = self.keys_[columns] == keys
+        counts = scipy.sparse.csr_matrix((numpy.ones(int(found.sum()), dtype=numpy.int64), (rows[found], columns[found])), shape=(len(docs), len(self.keys_)))
+        counts.sum_duplicates()
+        return counts